@@ -1,150 +1,377 @@
 #!/usr/bin/python3
-import argparse, subprocess, time, sys, json, pyfits, numpy
+import argparse, subprocess, time, sys, json, math, os, sqlite3, datetime, pyfits, numpy
+import concurrent.futures
+import statslib
 
 class flatDB:
+	""" History of the biases and flats taken, kept in an SQLite database. Every flat is a single inserted row committed on its own,
+	    so a write costs the same however long the history is, and a crash during twilight loses at most the flat being written.
+	    Flats are indexed by camera, filter, night and binning so the query helpers don't need to read the whole history. """
 	def __init__(self): 
-		self.filename="flats.json"
+		self.filename="flats.db"
+		self.legacyFilename="flats.json"
+		self.connection = None
 		print("Creating an instance of the database")
 		
 	def createNew(self):
-		self.db = { "cameraNames" : [ "TWFC1", "TWFC2"]}
-		self.dump()
-		
-	def dump(self, filename="none"):
-		if filename == "none": filename = self.filename
-		else: self.filename = filename
-		
-		jsonFile = open(self.filename, 'wt')
-		json.dump(self.db, jsonFile, indent=4)
-		jsonFile.close()
+		cursor = self.connection
+		cursor.execute("CREATE TABLE IF NOT EXISTS cameras (camera TEXT PRIMARY KEY, bias TEXT, biasMedian REAL)")
+		cursor.execute("CREATE TABLE IF NOT EXISTS flats (id INTEGER PRIMARY KEY, camera TEXT, filter TEXT, night TEXT, binning INTEGER, startTime REAL, expTime REAL, median REAL, maximum REAL, clippedFraction REAL, filename TEXT, data TEXT)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS flatsByFilter ON flats (camera, filter, night)")
+		cursor.execute("CREATE INDEX IF NOT EXISTS flatsByNight ON flats (night, binning)")
+		if cursor.execute("SELECT COUNT(*) FROM cameras").fetchone()[0]==0:
+			for camera in [ "TWFC1", "TWFC2"]:
+				cursor.execute("INSERT INTO cameras (camera) VALUES (?)", (camera, ))
+		self.connection.commit()
 
 	def load(self, filename="none"):
 		if filename == "none": filename = self.filename
 		else: self.filename = filename
 		
+		isNew = not os.path.exists(self.filename)
+		# With a write-ahead log each commit is atomic and survives a crash
+		self.connection = sqlite3.connect(self.filename)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.createNew()
+		information("...loaded from the file: " + str(self.filename))
+		if isNew and os.path.exists(self.legacyFilename): self.importJSON(self.legacyFilename)
+		
+	def importJSON(self, filename):
+		""" Copies the history from an old flats.json into the database. """
 		try:
-			jsonFile = open(self.filename, 'rt')
-			self.db = json.loads(jsonFile.read())
+			jsonFile = open(filename, 'rt')
+			db = json.loads(jsonFile.read())
 			jsonFile.close()
-			information("...loaded from the file: " + str(self.filename))
 		except Exception as e:
-			# information(e)
-			information("Unable to load: " + str(self.filename))
-			information("...creating a new datafile from the defaults...")
-			self.createNew()
-			self.dump()
-			
+			information("Unable to import: " + str(filename))
+			return
+		with self.connection:
+			for camera in db.get('cameraNames', []):
+				entry = db.get(camera, {})
+				self.connection.execute("INSERT OR REPLACE INTO cameras (camera, bias, biasMedian) VALUES (?, ?, ?)", (camera, entry.get('bias'), entry.get('biasMedian')))
+				for filter, flats in entry.items():
+					if not isinstance(flats, list): continue
+					for data in flats:
+						if data.get('startTime') is None: data = dict(data, startTime=getStartTime(data.get('filename')))
+						self.insertFlat(camera, filter, data)
+		information("...imported the history from: " + str(filename))
+
 	def checkBiases(self):
 		gotBiases = True
 		biasesNeeded =[]
-		for camera in self.db['cameraNames']:
-			try: 
-				biasFilename = self.db[camera]['bias'] 
-			except KeyError:
-				information("No bias saved for camera %s."%camera)
+		for row in self.connection.execute("SELECT camera, bias FROM cameras ORDER BY camera"):
+			if row['bias'] is None:
+				information("No bias saved for camera %s."%row['camera'])
 				gotBiases = False
-				biasesNeeded.append(camera)
+				biasesNeeded.append(row['camera'])
 		return gotBiases, biasesNeeded
 
+	def getBias(self, camera):
+		""" Returns the camera's entry (bias filename and biasMedian) as a dictionary, or None. """
+		row = self.connection.execute("SELECT bias, biasMedian FROM cameras WHERE camera=?", (camera, )).fetchone()
+		if row is None or row['bias'] is None: return None
+		return dict(row)
+
 	def addEntry(self, camera, data): 
-		try: 
-			self.db[camera] = data
-		except KeyError:
-			self.db[camera] = {}
-			self.db[camera] = data
-		self.dump()
-		
+		with self.connection:
+			self.connection.execute("INSERT OR REPLACE INTO cameras (camera, bias, biasMedian) VALUES (?, ?, ?)", (camera, data.get('bias'), data.get('biasMedian')))
+
+	def insertFlat(self, camera, filter, data):
+		""" Values the flat doesn't have (eg in legacy flats.json entries) are stored as NULL. Flats without a start time get no night,
+		    so they are left out of the per-night selections. """
+		startTime = data.get('startTime')
+		night = None
+		# Flats belong to the night that started at noon on the day before
+		if startTime is not None: night = time.strftime("%Y%m%d", time.localtime(startTime - 12*3600))
+		self.connection.execute("INSERT INTO flats (camera, filter, night, binning, startTime, expTime, median, maximum, clippedFraction, filename, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+			(camera, filter, night, data.get('binning'), startTime, data.get('expTime'), data.get('median'), data.get('maximum'), data.get('clippedFraction'), data.get('filename'), json.dumps(data)))
+
 	def addFlat(self, camera, filter, data):
-		keys = self.db.keys()
-		for k in keys:
-			print(k)
-		try:
-			self.db[camera][filter].append(data)
-		except KeyError:
-			self.db[camera][filter] = []
-			self.db[camera][filter].append(data)
-		self.dump()
+		with self.connection:
+			self.insertFlat(camera, filter, data)
+
+	def getFlats(self, camera=None, filter=None, night=None, binning=None):
+		""" Returns the flats (as dictionaries, oldest first) matching the given camera, filter, night (YYYYMMDD) and binning. """
+		conditions = []
+		values = []
+		for column, value in [('camera', camera), ('filter', filter), ('night', night), ('binning', binning)]:
+			if value is None: continue
+			conditions.append(column + "=?")
+			values.append(value)
+		query = "SELECT * FROM flats"
+		if len(conditions)>0: query+= " WHERE " + " AND ".join(conditions)
+		return [ dict(row) for row in self.connection.execute(query + " ORDER BY startTime", values) ]
+
+	def bestFlats(self, filter, camera=None, binning=None, number=5, minCounts=15000, maxCounts=50000, target=35000):
+		""" Returns up to 'number' flats in this filter from the most recent night that has any good ones (median between minCounts and
+		    maxCounts, no saturated pixels), those with the median closest to target first. Flats with an unknown night or saturation are left out. """
+		conditions = "filter=? AND night IS NOT NULL AND median>? AND maximum<? AND clippedFraction IS NOT NULL AND clippedFraction=0"
+		values = [filter, minCounts, maxCounts]
+		for column, value in [('camera', camera), ('binning', binning)]:
+			if value is None: continue
+			conditions+= " AND " + column + "=?"
+			values.append(value)
+		query = "SELECT * FROM flats WHERE " + conditions + " AND night=(SELECT MAX(night) FROM flats WHERE " + conditions + ") ORDER BY ABS(median-?) LIMIT ?"
+		return [ dict(row) for row in self.connection.execute(query, values + values + [target, number]) ]
+
+	def close(self):
+		if self.connection is not None: self.connection.close()
+		self.connection = None
 			
 
-def execute(command):
+class twilightModel:
+	""" Model of the twilight sky brightness, counts per second = A x exp(k x t), fitted to the flats taken so far.
+	    Each camera/filter has its own brightness A, but they all share the rate of change k, so every flat improves the
+	    prediction for all of them. Used to choose the exposure time of the next flat. """
+	def __init__(self, evening=True, timescale=600.):
+		self.points = {}
+		# Before there are two points for any filter, assume the sky changes by a factor e every 'timescale' seconds
+		self.defaultSlope = -1./timescale if evening else 1./timescale
+		self.evening = evening
+
+	def add(self, key, midTime, countsPerSecond, saturated=False):
+		""" Adds a measured sky rate. Saturated exposures (median clipped) and ones with no counts above the bias only give a limit
+		    on the rate, so they are not stored. Returns True if the point was stored. """
+		if saturated or countsPerSecond<=0: return False
+		if key not in self.points: self.points[key] = []
+		self.points[key].append((midTime, math.log(countsPerSecond)))
+		return True
+
+	def getSlope(self):
+		""" Least-squares slope of log(counts per second) against time, shared between all the filters. """
+		covariance = 0
+		variance = 0
+		for key in self.points:
+			t = numpy.array([ p[0] for p in self.points[key] ])
+			y = numpy.array([ p[1] for p in self.points[key] ])
+			covariance+= numpy.sum((t - t.mean()) * (y - y.mean()))
+			variance+= numpy.sum((t - t.mean())**2)
+		if variance==0: return self.defaultSlope
+		slope = covariance / variance
+		# A sky getting brighter in the evening (or darker in the morning) is noise: fall back to the default
+		if (self.evening and slope>=0) or (not self.evening and slope<=0): return self.defaultSlope
+		return slope
+
+	def getRate(self, key, when):
+		""" Predicted counts per second for this camera/filter at time 'when', or None if it has not been measured yet. """
+		if key not in self.points: return None
+		slope = self.getSlope()
+		intercept = numpy.mean([ p[1] - slope * p[0] for p in self.points[key] ])
+		return math.exp(intercept + slope * when)
+
+	def predictExposure(self, key, start, counts):
+		""" Exposure time needed to collect 'counts' above the bias in an exposure starting at 'start', allowing for the sky changing during the exposure. """
+		rate = self.getRate(key, start)
+		if rate is None: return None
+		slope = self.getSlope()
+		argument = 1 + counts * slope / rate
+		if argument<=0: return math.inf		# The sky fades too quickly to ever reach the counts
+		return math.log(argument) / slope
+
+	def waitTime(self, key, start, minExposure, counts):
+		""" Seconds to wait after 'start' before the sky is faint enough for 'counts' in minExposure (evening only). """
+		rate = self.getRate(key, start)
+		slope = self.getSlope()
+		targetRate = counts * slope / (math.exp(slope * minExposure) - 1)
+		return max(0., math.log(targetRate / rate) / slope)
+
+def execute(command, onImageSaved=None):
+	""" Runs a command once, echoing its output as it arrives, and returns everything it wrote to stdout. A non-zero exit code is reported.
+	    If given, onImageSaved(filename) is called as soon as an "Image saved as" line appears, while the command may still be running. """
 	commandParts = []
 	for part in command.split(' '):
 		commandParts.append(str(part))
 	information("executing command: " + command)
 	print(commandParts)
-	subprocess.call(commandParts)
-	cmd = subprocess.Popen(commandParts, stdout=subprocess.PIPE)
+	cmd = subprocess.Popen(commandParts, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
 	stdoutStr = ""
 	for line in cmd.stdout:
-		stdoutStr+= str(line.decode('utf-8'))
-	# cmd.terminate()
+		sys.stdout.write(line)
+		stdoutStr+= line
+		if onImageSaved is not None and "Image saved as" in line:
+			onImageSaved(line.strip().split(' ')[-1])
+	cmd.wait()
+	if cmd.returncode!=0: information("Command failed with exit code %d: %s"%(cmd.returncode, command), error=True)
 	return stdoutStr
+
+statsPool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+def executeWithStats(command):
+	""" Runs an exposure command and starts measuring the image in the background as soon as it is saved.
+	    Returns the filename and (maximum, minimum, median, clippedFraction). """
+	saved = []
+	def imageSaved(filename):
+		saved.append((filename, statsPool.submit(getStats, filename)))
+	execute(command, onImageSaved=imageSaved)
+	if len(saved)==0: 
+		raise RuntimeError("No image was saved by: " + command)
+	filename, stats = saved[-1]
+	return filename, stats.result()
 	
 		
+def getStartTime(filename):
+	""" The start time (Unix time) of an exposure from the DATE-OBS (and UTSTART) in its header, or None if the file or the date is missing. """
+	if filename is None or not os.path.exists(filename): return None
+	try:
+		header = pyfits.getheader(filename)
+		dateString = str(header['DATE-OBS'])
+		if 'T' not in dateString and 'UTSTART' in header: dateString+= "T" + str(header['UTSTART'])
+		when = datetime.datetime.fromisoformat(dateString)
+	except (KeyError, ValueError, OSError):
+		return None
+	return when.replace(tzinfo=datetime.timezone.utc).timestamp()
+
 def information(message, error=False):
 	print(message)
 	
 def makeBias(camera):
 	biasCommand = "indicam -b " + str(binning) + " bias " + camera
-	stdoutStr = execute(biasCommand)
-	for line in stdoutStr.split('\n'):
-		if "Image saved as" in line:
-			biasFilename = line.split(' ')[-1]
+	biasFilename, (maximum, minimum, median, clippedFraction) = executeWithStats(biasCommand)
 	information("Made a bias for %s, stored as %s."%(camera, biasFilename))
-	median, minimum, maximum = getStats(biasFilename)
 	print("bias median", median)	
 	
 	flatData.addEntry(camera, { "bias" : biasFilename, "biasMedian": median} )
 	
-def getFilenameFromStdout(stdoutStr):
-	for line in stdoutStr.split('\n'):
-		if "Image saved as" in line:
-			filename = line.split(' ')[-1]
-	return filename
+# Image statistics are measured on a central section covering statsFraction of each axis, sampling every statsStep-th pixel
+statsFraction = 0.5
+statsStep = 4
+saturation = 65535
 
-def getStats(filename):
-	h2=pyfits.open(filename)
-	data2=h2[0].data
-	median=numpy.median(numpy.median(data2, axis=0))
-	maximum = numpy.max(data2)
-	minimum = numpy.min(data2)
+def getSection(filename):
+	""" Reads the central statistics section of an image from disk on a sparse grid, without loading the whole frame. """
+	h2=pyfits.open(filename, memmap=False)
+	height, width = h2[0].header['NAXIS2'], h2[0].header['NAXIS1']
+	border = (1 - statsFraction) / 2
+	top, left = int(height * border), int(width * border)
+	# Strided row reads are fast; strided column reads in astropy sections are not, so the columns are sampled in memory
+	sample = h2[0].section[top:height-top:statsStep][:, left:width-left:statsStep]
 	h2.close()
-	return float(maximum), float(minimum), float(median)
+	return sample
+
+def getStats(filename):
+	""" Returns the maximum, minimum and median counts and the fraction of saturated pixels, measured on the central section of the image. """
+	sectionStats = statslib.histogram(getSection(filename), saturation=saturation)
+	clippedFraction = sectionStats.saturated() / sectionStats.n
+	return float(sectionStats.maximum), float(sectionStats.minimum), float(sectionStats.median()), float(clippedFraction)
 
 def getMedian(filename):
-	h2=pyfits.open(filename)
-	data2=h2[0].data
-	median=numpy.median(numpy.median(data2, axis=0))
-	h2.close()
-	return median
+	return statslib.histogram(getSection(filename)).median()
 	
 def makeFlat(camera, filter, expTime):
+	""" Takes a flat and returns the time the exposure started, the median and maximum counts and the fraction of saturated pixels. """
 	information("Taking a flat for %s, filter %s"%(camera, filter))
 	flatCommand = "indicam -b " + str(binning) + " flat " + camera + " " + str(expTime)
-	stdoutStr = execute(flatCommand)
-	flatFilename = getFilenameFromStdout(stdoutStr)
-	maximum, minimum, median = getStats(flatFilename)
-	print(flatFilename, maximum, minimum, median)
-	flatData.addFlat(camera, filter, { 'filename' : flatFilename, 'median': median, 'maximum': maximum, })
-	
-def checkExposureTime(camera, filter):
-	checkExp = 1
+	startTime = time.time()
+	flatFilename, (maximum, minimum, median, clippedFraction) = executeWithStats(flatCommand)
+	print(flatFilename, maximum, minimum, median, clippedFraction)
+	flatData.addFlat(camera, filter, { 'filename' : flatFilename, 'median': median, 'maximum': maximum, 'clippedFraction': clippedFraction, 'expTime': expTime, 'startTime': startTime, 'binning': binning })
+	return startTime, median, maximum, clippedFraction
+	
+def checkExposureTime(camera, filter, checkExp=1):
+	""" Takes a short windowed exposure and returns the time it started, its length, its median counts and the fraction of saturated pixels. """
 	information("Checking exposure time for %s, filter %s"%(camera, filter))
 	expCommand = "indicam -w \"[3200:6000,1800:4500]\" -b " + str(binning) + " run " + camera + " " + str(checkExp)
 	print(expCommand)
-	stdoutStr = execute(expCommand) 
+	startTime = time.time()
+	checkFilename, (maximum, minimum, median, clippedFraction) = executeWithStats(expCommand)
+	return startTime, checkExp, median, clippedFraction
+
+def setFilter(camera, filter):
+	execute("indicam filter " + camera + " -f " + filter)
+
+def getBiasLevel(camera):
+	bias = flatData.getBias(camera)
+	if bias is None or bias['biasMedian'] is None: return 0
+	return bias['biasMedian']
+
+def runFlatSequence(cameras, filters, numFlats, evening=True):
+	""" Takes numFlats good flats for each camera and filter, alternating between cameras and working through the filters.
+	    The exposure time of each flat is predicted from the twilight model so that the median lands on countsAim. """
+	model = twilightModel(evening)
+	plan = [ (camera, filter) for filter in filters for camera in cameras ]
+	goodFlats = { key: 0 for key in plan }
+	checkExposures = { key: 1 for key in plan }
+	# Halved each time a flat comes back saturated, as a saturated flat doesn't tell the model how bright the sky is
+	shortening = { key: 1 for key in plan }
+	finished = []
+	currentFilter = {}
+	while len(finished)<len(plan):
+		waits = []
+		for key in plan:
+			if key in finished: continue
+			camera, filter = key
+			if currentFilter.get(camera)!=filter:
+				setFilter(camera, filter)
+				currentFilter[camera] = filter
+			biasLevel = getBiasLevel(camera)
+			if model.getRate(key, time.time()) is None:
+				startTime, checkExp, median, clippedFraction = checkExposureTime(camera, filter, checkExposures[key])
+				saturated = clippedFraction>=0.5
+				if not model.add(key, startTime + checkExp/2, (median - biasLevel) / checkExp, saturated):
+					if saturated and checkExp/2>=minExposure:
+						information("Check exposure saturated for %s, filter %s. Trying %.2f s."%(camera, filter, checkExp/2))
+						checkExposures[key] = checkExp/2
+					elif saturated==evening:
+						# Too bright in the evening or too dark in the morning: the sky will get there
+						information("Sky too %s for %s, filter %s. Checking again soon."%("bright" if saturated else "dark", camera, filter))
+						waits.append(60)
+					else:
+						information("Sky too %s for %s, filter %s. Finished with %d flats."%("bright" if saturated else "dark", camera, filter, goodFlats[key]))
+						finished.append(key)
+					continue
+			start = time.time() + overhead
+			expTime = model.predictExposure(key, start, countsAim - biasLevel) * shortening[key]
+			information("%s %s: predicted exposure time %.2f s"%(camera, filter, expTime))
+			if expTime>maxExposure:
+				if evening: 
+					information("Too dark for %s, filter %s. Finished with %d flats."%(camera, filter, goodFlats[key]))
+					finished.append(key)
+				else: waits.append(60)
+				continue
+			if expTime<minExposure:
+				if evening: waits.append(model.waitTime(key, start, minExposure, countsAim - biasLevel))
+				else: 
+					information("Too bright for %s, filter %s. Finished with %d flats."%(camera, filter, goodFlats[key]))
+					finished.append(key)
+				continue
+			expTime = round(expTime, 2)
+			startTime, median, maximum, clippedFraction = makeFlat(camera, filter, expTime)
+			if model.add(key, startTime + expTime/2, (median - biasLevel) / expTime, clippedFraction>=0.5): shortening[key] = 1
+			elif clippedFraction>=0.5: shortening[key]/= 2
+			if maximum<maxCounts and median>minCounts: goodFlats[key]+= 1
+			else: information("Flat rejected: median %d, maximum %d"%(median, maximum))
+			if goodFlats[key]>=numFlats: 
+				information("Done %d flats for %s, filter %s."%(goodFlats[key], camera, filter))
+				finished.append(key)
+		if len(waits)>0 and len(waits)==len(plan)-len(finished):
+			# Nothing could be exposed this time round, wait for the sky to change
+			wait = min(60, max(1, min(waits)))
+			information("Waiting %.0f seconds for the sky to change."%wait)
+			time.sleep(wait)
 	
 	
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Takes flats at morning and evening twilight for the TWFC cameras at the WHT.')
 	parser.add_argument('-b', '--binning', type=int, default=1, help='Binning for the flats. Default is 1x1.' )	
+	parser.add_argument('-c', '--cameras', type=str, nargs='+', default=["TWFC1", "TWFC2"], help='Cameras to take flats with. Default is TWFC1 TWFC2.')
+	parser.add_argument('-f', '--filters', type=str, nargs='+', default=["R"], help='Filters to take flats in, in order. Default is R.')
+	parser.add_argument('-n', '--numflats', type=int, default=5, help='Number of good flats to take for each camera and filter. Default is 5.')
+	parser.add_argument('--statsfraction', type=float, default=0.5, help='Fraction of each axis (centred) used to measure the flat statistics. Default is 0.5.')
+	parser.add_argument('--statsstep', type=int, default=4, help='Sample every n-th pixel when measuring the flat statistics. Default is 4.')
+	parser.add_argument('--morning', action="store_true", help='Morning twilight (the sky is getting brighter). Default is evening after noon, morning before.')
 	args = parser.parse_args()
 	binning = args.binning
 	binning = 4
 	maxCounts = 50000
 	countsAim = 35000
+	minCounts = 15000
 	minExposure = 0.5
 	maxExposure = 45
+	statsFraction = args.statsfraction
+	statsStep = args.statsstep
+	overhead = 5		# Seconds between deciding on an exposure and the shutter opening
+	evening = not args.morning and time.localtime().tm_hour>=12
 	
 	
 	flatData = flatDB()
@@ -155,8 +382,7 @@ if __name__ == "__main__":
 		for b in biasesNeeded:
 			makeBias(b)
 
-	checkExposureTime("TWFC1", "R")
-	makeFlat("TWFC2", "R", 1)
+	runFlatSequence(args.cameras, args.filters, args.numflats, evening=evening)
 	
 	
 	
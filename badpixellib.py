@@ -0,0 +1,92 @@
+import numpy
+import astropy.io.fits
+import calibrationlib
+
+class badPixelIndex:
+	""" The bad pixels of a detector stored as a sparse list of flat pixel positions, as written by findHotPixels.py.
+	    Frames are repaired by averaging each bad pixel's good neighbours, so the cost per frame depends only on the number of bad pixels.
+	    binning is the (x, y) binning of the mask itself, read from a FITS mask's header (1x1 if it has none). """
+	neighbourOffsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+	def __init__(self, filename=None, shape=None):
+		self.shape = shape
+		self.binning = (1, 1)
+		self.indices = numpy.zeros(0, dtype=numpy.intp)
+		self.windows = {}
+		self.neighbours = None
+		self.mask = None
+		if filename is not None: self.load(filename, shape)
+
+	def load(self, filename, shape=None):
+		""" Loads a FITS mask (non-zero = bad) or a text list of 'x, y' positions. A text list needs the frame shape. """
+		if '.fits' in filename or filename.endswith('.fit'):
+			hdul = astropy.io.fits.open(filename)
+			mask = hdul[0].data
+			self.binning = calibrationlib.getBinFactors(hdul[0].header)
+			hdul.close()
+			self.shape = numpy.shape(mask)
+			self.indices = numpy.flatnonzero(mask)
+		else:
+			if shape is None: raise ValueError("Need the frame shape to load the pixel list %s"%filename)
+			pixels = numpy.loadtxt(filename, delimiter=',', comments='#', dtype=int, ndmin=2)
+			self.shape = tuple(shape)
+			self.indices = numpy.unique(numpy.ravel_multi_index((pixels[:, 1], pixels[:, 0]), self.shape))
+		self.neighbours = None
+		self.mask = None
+		print("Loaded %d bad pixels from %s"%(len(self.indices), filename))
+
+	def setIndices(self, indices, shape, binning=(1, 1)):
+		self.shape = tuple(shape)
+		self.binning = binning
+		self.indices = numpy.asarray(indices, dtype=numpy.intp)
+		self.neighbours = None
+		self.mask = None
+
+	def getNeighbours(self):
+		""" (y, x) positions of the 8 neighbours of each bad pixel and whether each one is usable (inside the frame and not bad itself). Computed once. """
+		if self.neighbours is not None: return self.neighbours
+		height, width = self.shape
+		y, x = numpy.unravel_index(self.indices, self.shape)
+		neighboursY = []
+		neighboursX = []
+		good = []
+		for dy, dx in badPixelIndex.neighbourOffsets:
+			inside = (y+dy>=0) & (y+dy<height) & (x+dx>=0) & (x+dx<width)
+			ny = numpy.where(inside, y+dy, 0)
+			nx = numpy.where(inside, x+dx, 0)
+			neighboursY.append(ny)
+			neighboursX.append(nx)
+			good.append(inside & ~numpy.isin(ny * width + nx, self.indices))
+		self.neighbours = ((y, x), (numpy.array(neighboursY).T, numpy.array(neighboursX).T), numpy.array(good).T)
+		return self.neighbours
+
+	def repair(self, imageData):
+		""" Replaces the bad pixels of imageData (in place) with the mean of their good neighbours and returns it. Pixels with no good neighbours are left alone. """
+		if len(self.indices)==0: return imageData
+		(y, x), (neighboursY, neighboursX), good = self.getNeighbours()
+		values = imageData[neighboursY, neighboursX]
+		counts = numpy.sum(good, axis=1)
+		fixable = counts>0
+		means = numpy.sum(numpy.where(good, values, 0), axis=1)[fixable] / counts[fixable]
+		imageData[y[fixable], x[fixable]] = means
+		return imageData
+
+	def getMask(self):
+		""" Boolean mask of the bad pixels (True = bad), eg for photutils aperture_photometry. Built once. """
+		if self.mask is None or self.mask.shape!=self.shape:
+			self.mask = numpy.zeros(self.shape, dtype=bool)
+			self.mask.ravel()[self.indices] = True
+		return self.mask
+
+	def forFrame(self, header, shape):
+		""" Returns the bad pixel index matching a (possibly windowed and binned) frame. A binned pixel is bad if any pixel in it is bad. Cached by window.
+		    A mask that already has the frame's shape is used as it is. """
+		shape = tuple(shape)
+		if shape==self.shape: return self
+		key = (calibrationlib.getWindow(header), calibrationlib.getBinFactors(header), shape)
+		if key not in self.windows:
+			windowed = calibrationlib.extractWindow(self.getMask().astype(numpy.float32), header, self.binning, shape=shape)
+			self.windows[key] = badPixelIndex()
+			self.windows[key].setIndices(numpy.flatnonzero(windowed), shape, key[1])
+			print("%d bad pixels in window %s binning %dx%d"%(len(self.windows[key].indices), key[0], key[1][0], key[1][1]))
+		return self.windows[key]
@@ -0,0 +1,210 @@
+import datetime, hashlib, json, os
+import numpy
+import astropy.io.fits
+
+cameraKeywords = ['INSTRUME', 'CAMERA', 'DETECTOR']
+
+def getHeaderValue(header, keywords, default="unknown"):
+	""" Returns the value of the first keyword found in the header (an astropy Header or a dictionary). """
+	for k in keywords:
+		if k in header: return str(header[k]).strip()
+	return default
+
+def getBinning(header):
+	if 'CCDSUM' in header: return " ".join(str(header['CCDSUM']).split())
+	if 'CCDXBIN' in header: return "%s %s"%(header['CCDXBIN'], header.get('CCDYBIN', header['CCDXBIN']))
+	return "unknown"
+
+def getWindow(header):
+	""" The WINSEC4 window definition if windowing is enabled, otherwise 'full'. """
+	window = str(header.get('WINSEC4', ""))
+	if 'enabled' not in window: return "full"
+	return window[window.find('['):window.find(']')+1]
+
+def parseWindow(header):
+	""" Returns the window (xStart, xEnd, yStart, yEnd) from the WINSEC4 header in unbinned pixels, or None if windowing is not enabled. """
+	window = str(header.get('WINSEC4', ""))
+	if 'enabled' not in window: return None
+	dimensionString = window[window.find('[')+1:window.find(']')]
+	xDimensions, yDimensions = dimensionString.split(',')
+	xStart, xEnd = [ int(x) for x in xDimensions.split(':') ]
+	yStart, yEnd = [ int(y) for y in yDimensions.split(':') ]
+	return xStart, xEnd, yStart, yEnd
+
+def getBinFactors(header):
+	""" Returns the (x, y) binning of a frame, defaulting to 1x1. """
+	if 'CCDXBIN' in header: return int(header['CCDXBIN']), int(header.get('CCDYBIN', header['CCDXBIN']))
+	if 'CCDSUM' in header:
+		binning = str(header['CCDSUM']).split()
+		return int(binning[0]), int(binning[-1])
+	return 1, 1
+
+def rebinMean(data, xbin, ybin):
+	""" Averages data in blocks of xbin x ybin pixels. Partial blocks at the edges are averaged over the pixels they contain. """
+	if xbin==1 and ybin==1: return data
+	rows = numpy.arange(0, data.shape[0], ybin)
+	columns = numpy.arange(0, data.shape[1], xbin)
+	sums = numpy.add.reduceat(numpy.add.reduceat(data, rows, axis=0, dtype=numpy.float64), columns, axis=1)
+	rowCounts = numpy.diff(numpy.append(rows, data.shape[0]))
+	columnCounts = numpy.diff(numpy.append(columns, data.shape[1]))
+	return sums / numpy.outer(rowCounts, columnCounts)
+
+# Offset (x, y) from WINSEC4 coordinates to pixels in a full frame, as measured with sampleFlat.py
+windowOffset = (47, -1)
+
+def extractWindow(fullFrame, header, fullBinning=(1, 1), shape=None):
+	""" Cuts the region of a full-frame calibration image (eg a balance frame) that matches the window and binning in a science frame's header.
+	    fullBinning is the binning of the full frame. If the science frame shape is given, the result is checked (and trimmed) to match it. """
+	xbin, ybin = getBinFactors(header)
+	if xbin%fullBinning[0]!=0 or ybin%fullBinning[1]!=0:
+		raise ValueError("Can't make a %dx%d frame from a %dx%d one."%(xbin, ybin, fullBinning[0], fullBinning[1]))
+	window = parseWindow(header)
+	sampled = fullFrame
+	if window is not None:
+		xStart, xEnd, yStart, yEnd = window
+		xOffset, yOffset = windowOffset
+		left, right = (xStart + xOffset) // fullBinning[0], (xEnd + xOffset + 1) // fullBinning[0]
+		bottom, top = (yStart + yOffset) // fullBinning[1], (yEnd + yOffset) // fullBinning[1]
+		sampled = fullFrame[max(0, bottom):top, max(0, left):right]
+	sampled = rebinMean(sampled, xbin // fullBinning[0], ybin // fullBinning[1])
+	if shape is not None:
+		if sampled.shape[0]<shape[0] or sampled.shape[1]<shape[1]:
+			raise ValueError("Window %s binned %dx%d gives a %s frame, smaller than the science frame %s."%(window, xbin, ybin, sampled.shape, tuple(shape)))
+		sampled = sampled[:shape[0], :shape[1]]
+	return sampled
+
+class balanceCache:
+	""" Serves balance frames cut from a single full-frame balance for any window and binning. Each window/binning is extracted once and kept.
+	    fullBinning is the binning of the balance itself; use getBinFactors on its header. """
+	def __init__(self, fullBalance, fullBinning=(1, 1)):
+		self.fullBalance = fullBalance
+		self.fullBinning = fullBinning
+		self.cache = {}
+
+	def get(self, header, shape=None):
+		""" Returns the balance frame for a science frame with this header (and data shape). """
+		if shape is None and header.get('NAXIS', 0)==2: shape = (header['NAXIS2'], header['NAXIS1'])
+		key = (getWindow(header), getBinFactors(header), None if shape is None else tuple(shape))
+		if key in self.cache: return self.cache[key]
+		if shape is not None and numpy.shape(self.fullBalance)==tuple(shape):
+			# Already the right size for this frame (eg a balance made from flats with the same window)
+			balance = self.fullBalance
+		else:
+			balance = extractWindow(self.fullBalance, header, self.fullBinning, shape)
+			print("Cut a %s balance frame for window %s binning %dx%d"%(numpy.shape(balance), key[0], key[1][0], key[1][1]))
+		self.cache[key] = balance
+		return balance
+
+class libraryBalances:
+	""" Serves the balance frames of a calibration library in the same way as balanceCache, for frames with any window and binning. """
+	def __init__(self, library):
+		self.library = library
+
+	def get(self, header, shape=None):
+		balance = self.library.getBalance(header, shape)
+		if balance is None: raise ValueError("No balance in %s for binning %s window %s"%(self.library.path, getBinning(header), getWindow(header)))
+		return balance
+
+class calibrationLibrary:
+	""" Stores master bias and balance frames, indexed by the instrument configuration they were taken with.
+	    Frames are saved under a name derived from their contents, so the same master is never stored twice. """
+	kinds = ['bias', 'balance']
+
+	def __init__(self, path="calibrations"):
+		self.path = path
+		self.indexFilename = os.path.join(path, "library.json")
+		self.index = {}
+		self.loaded = {}
+		self.balances = {}
+		self.load()
+
+	def load(self):
+		if not os.path.exists(self.indexFilename): return
+		indexFile = open(self.indexFilename, 'rt')
+		self.index = json.load(indexFile)
+		indexFile.close()
+
+	def save(self):
+		os.makedirs(self.path, exist_ok=True)
+		temporaryFilename = self.indexFilename + ".tmp"
+		indexFile = open(temporaryFilename, 'wt')
+		json.dump(self.index, indexFile, indent=4)
+		indexFile.close()
+		os.replace(temporaryFilename, self.indexFilename)
+
+	def getConfiguration(self, kind, header):
+		""" The instrument configuration of a frame (as a dictionary) that a master of this kind must match. """
+		configuration = { 'kind': kind }
+		configuration['camera'] = getHeaderValue(header, cameraKeywords)
+		configuration['binning'] = getBinning(header)
+		configuration['speed'] = getHeaderValue(header, ['CCDSPEED'])
+		configuration['window'] = getWindow(header)
+		if kind=='balance': configuration['filter'] = getHeaderValue(header, ['FILTER'])
+		return configuration
+
+	def getKey(self, kind, header):
+		configuration = self.getConfiguration(kind, header)
+		return "|".join([ configuration[k] for k in sorted(configuration.keys()) ])
+
+	def add(self, kind, data, header, sources=None):
+		""" Stores a master frame for the configuration described by header (a header from one of the frames used to make it). Returns the stored filename. """
+		if kind not in calibrationLibrary.kinds:
+			raise ValueError("Unknown calibration kind: %s"%kind)
+		data = numpy.ascontiguousarray(data)
+		digest = hashlib.sha1(data.tobytes()).hexdigest()
+		filename = os.path.join(self.path, "%s_%s.fits"%(kind, digest[:16]))
+		os.makedirs(self.path, exist_ok=True)
+		if not os.path.exists(filename):
+			masterHeader = astropy.io.fits.Header()
+			for k, v in self.getConfiguration(kind, header).items():
+				masterHeader['CAL' + k.upper()[:5]] = v
+			astropy.io.fits.PrimaryHDU(data, header=masterHeader).writeto(filename)
+		key = self.getKey(kind, header)
+		self.index[key] = { 'filename': os.path.basename(filename), 'sha1': digest, 'created': str(datetime.datetime.now()), 'sources': list(sources or []) }
+		self.loaded.pop(key, None)
+		self.save()
+		print("Stored %s master as %s for %s"%(kind, filename, key))
+		return filename
+
+	def lookup(self, kind, header):
+		""" Returns the filename of the master matching this frame's configuration, or None. """
+		entry = self.index.get(self.getKey(kind, header))
+		if entry is None: return None
+		return os.path.join(self.path, entry['filename'])
+
+	def getMaster(self, kind, header):
+		""" Returns the (memory-mapped) master frame matching this frame's configuration, or None if the library has no match. """
+		key = self.getKey(kind, header)
+		if key in self.loaded: return self.loaded[key]
+		filename = self.lookup(kind, header)
+		if filename is None: return None
+		hdul = astropy.io.fits.open(filename, memmap=True)
+		data = hdul[0].data
+		hdul.close()
+		self.loaded[key] = data
+		print("Using %s master %s"%(kind, filename))
+		return data
+
+	def getMasterBinning(self, kind, header):
+		""" The (x, y) binning recorded in the header of the master matching this frame's configuration. """
+		masterHeader = astropy.io.fits.getheader(self.lookup(kind, header))
+		binning = str(masterHeader.get('CALBINNI', "1 1"))
+		if binning=="unknown": return 1, 1
+		return getBinFactors({ 'CCDSUM': binning })
+
+	def getBalance(self, header, shape=None):
+		""" Returns the balance frame for this frame's configuration. If there is no master for its window, one is cut from the
+		    full-frame, unbinned balance for the same camera, speed and filter and kept for later calls. """
+		balance = self.getMaster('balance', header)
+		if balance is not None: return balance
+		key = self.getKey('balance', header)
+		if key in self.balances: return self.balances[key].get(header, shape)
+		fullHeader = dict(header)
+		fullHeader.pop('WINSEC4', None)
+		fullHeader.pop('CCDXBIN', None)
+		fullHeader.pop('CCDYBIN', None)
+		fullHeader['CCDSUM'] = "1 1"
+		fullBalance = self.getMaster('balance', fullHeader)
+		if fullBalance is None: return None
+		self.balances[key] = balanceCache(fullBalance, self.getMasterBinning('balance', fullHeader))
+		return self.balances[key].get(header, shape)
@@ -1,4 +1,4 @@
-import json, numpy
+import json, math, numpy
 
 class apertureClass:
 	def __init__(self, position, peak):
@@ -114,6 +114,17 @@ class frameDB:
 		print(self.allFrames)
 		inputfile.close()
 
+def framePosition(frame, position):
+	""" Where a position in the aperture (reference) coordinates lands in a frame, from its frameDB record. The frame is shifted by
+	    (dx, dy) and, if it was registered with them, rotated (degrees, anticlockwise) and scaled about the record's 'centre'. """
+	x, y = position[0] + frame['dx'], position[1] + frame['dy']
+	if 'rotation' not in frame: return (x, y)
+	angle = math.radians(frame['rotation'])
+	scale = frame.get('scale', 1)
+	cx, cy = frame['centre'][0] + frame['dx'], frame['centre'][1] + frame['dy']
+	u, v = x - cx, y - cy
+	return (cx + scale * (u * math.cos(angle) - v * math.sin(angle)), cy + scale * (u * math.sin(angle) + v * math.cos(angle)))
+
 class target():
 	def __init__(self, id):
 		self.id = id
@@ -0,0 +1,160 @@
+import numpy
+import astropy.io.fits
+
+defaultMemoryLimit = 2048 * 1024**2		# Bytes available to hold one tile of the stack
+
+def openFrames(fileList):
+	""" Opens each FITS file memory-mapped and without applying BZERO/BSCALE so that rows can be read on demand. """
+	HDULists = []
+	for FITSfile in fileList:
+		HDULists.append(astropy.io.fits.open(FITSfile, memmap=True, do_not_scale_image_data=True))
+	return HDULists
+
+def closeFrames(HDULists):
+	for hdul in HDULists:
+		hdul.close()
+
+def getImageHDU(hdul, hdu=0):
+	""" Returns the requested HDU, or the first extension if the primary HDU is empty (eg .fits.fz files). """
+	if hdul[hdu].header['NAXIS']==0 and len(hdul)>hdu+1: return hdul[hdu+1]
+	return hdul[hdu]
+
+def readRows(HDU, start, end):
+	""" Reads rows start:end of an unscaled image HDU and applies BSCALE/BZERO the same way astropy does.
+	    Unsigned 16-bit data (BZERO = 32768) comes back as native uint16 without a float copy. """
+	raw = HDU.section[start:end]
+	bscale = HDU.header.get('BSCALE', 1)
+	bzero = HDU.header.get('BZERO', 0)
+	if bscale==1 and bzero==32768 and raw.dtype.kind=='i' and raw.dtype.itemsize==2:
+		return raw.astype(numpy.int16).view(numpy.uint16) ^ numpy.uint16(0x8000)
+	if bscale==1 and bzero==0:
+		return raw.astype(raw.dtype.newbyteorder('='))
+	if raw.dtype.itemsize<=2: scaledType = numpy.float32
+	else: scaledType = numpy.float64
+	return raw.astype(scaledType) * scaledType(bscale) + scaledType(bzero)
+
+def getTileHeight(numFrames, width, itemsize, memoryLimit):
+	""" Number of image rows per tile so that the stack of all frames fits in memoryLimit bytes. """
+	rowBytes = numFrames * width * itemsize
+	return max(1, int(memoryLimit // rowBytes))
+
+def medianCombine(fileList, bias=None, memoryLimit=defaultMemoryLimit, hdu=0):
+	""" Per-pixel median of a list of FITS frames, computed in row tiles so that only memoryLimit bytes of the stack are in memory at once.
+	    The frames are memory-mapped and kept in their native type (uint16 for raw frames). The result is identical to numpy.median(frames, axis=0).
+	    If a bias is given it is subtracted from each frame before the median is taken. """
+	HDULists = openFrames(fileList)
+	try:
+		HDUs = [ getImageHDU(hdul, hdu) for hdul in HDULists ]
+		height, width = HDUs[0].shape
+		for HDU, FITSfile in zip(HDUs, fileList):
+			if HDU.shape!=(height, width):
+				raise ValueError("%s has shape %s, expected %s"%(FITSfile, HDU.shape, (height, width)))
+		stackType = readRows(HDUs[0], 0, 1).dtype
+		if bias is not None: stackType = numpy.result_type(stackType, bias.dtype)
+		tileHeight = min(height, getTileHeight(len(HDUs), width, stackType.itemsize, memoryLimit))
+		print("Median combining %d frames of %dx%d in tiles of %d rows."%(len(HDUs), width, height, tileHeight))
+
+		combined = None
+		stack = numpy.empty((len(HDUs), tileHeight, width), dtype=stackType)
+		for start in range(0, height, tileHeight):
+			end = min(start + tileHeight, height)
+			tile = stack[:, :end-start]
+			for index, HDU in enumerate(HDUs):
+				if bias is not None: numpy.subtract(readRows(HDU, start, end), bias[start:end], out=tile[index])
+				else: tile[index] = readRows(HDU, start, end)
+			tileMedian = numpy.median(tile, axis=0, overwrite_input=True)
+			if combined is None: combined = numpy.empty((height, width), dtype=tileMedian.dtype)
+			combined[start:end] = tileMedian
+	finally:
+		closeFrames(HDULists)
+	return combined
+
+def readFrame(HDU, bias=None):
+	""" Reads a whole frame as float64, subtracting the bias if one is given. """
+	imageData = readRows(HDU, 0, HDU.shape[0]).astype(numpy.float64)
+	if bias is not None: imageData-= bias
+	return imageData
+
+def clippedMeanCombine(fileList, bias=None, sigma=3.0, hdu=0, memoryLimit=defaultMemoryLimit, minSpread=1.0):
+	""" Per-pixel sigma-clipped mean of a list of FITS frames, computed in row tiles like medianCombine.
+	    Values are rejected if they are more than sigma robust standard deviations (1.4826 x the median absolute deviation) from the median,
+	    so a single outlier can't widen the limit and a cosmic ray is rejected even from a handful of frames. The survivors are averaged.
+	    The robust standard deviation is at least minSpread (ADU), as integer frames often have a MAD of 0 at a pixel, which would keep
+	    only the values equal to the median. """
+	HDULists = openFrames(fileList)
+	try:
+		HDUs = [ getImageHDU(hdul, hdu) for hdul in HDULists ]
+		height, width = HDUs[0].shape
+		for HDU, FITSfile in zip(HDUs, fileList):
+			if HDU.shape!=(height, width):
+				raise ValueError("%s has shape %s, expected %s"%(FITSfile, HDU.shape, (height, width)))
+		# The stack and its deviations from the median are both held in memory
+		tileHeight = min(height, getTileHeight(2 * len(HDUs), width, 8, memoryLimit))
+		combined = numpy.empty((height, width))
+		stack = numpy.empty((len(HDUs), tileHeight, width))
+		deviations = numpy.empty((len(HDUs), tileHeight, width))
+		rejected = 0
+		for start in range(0, height, tileHeight):
+			end = min(start + tileHeight, height)
+			tile = stack[:, :end-start]
+			deviation = deviations[:, :end-start]
+			for index, HDU in enumerate(HDUs):
+				tile[index] = readRows(HDU, start, end)
+				if bias is not None: tile[index]-= bias[start:end]
+			median = numpy.median(tile, axis=0)
+			numpy.subtract(tile, median, out=deviation)
+			numpy.abs(deviation, out=deviation)
+			limit = numpy.median(deviation, axis=0)
+			limit*= 1.4826
+			numpy.maximum(limit, minSpread, out=limit)
+			limit*= sigma
+			keep = deviation<=limit
+			count = numpy.sum(keep, axis=0)
+			rejected+= keep.size - numpy.sum(count)
+			total = numpy.sum(tile, axis=0, where=keep)
+			combined[start:end] = numpy.divide(total, count, out=median, where=count>0)
+	finally:
+		closeFrames(HDULists)
+	print("Sigma-clipped mean of %d frames: rejected %d of %d pixel values."%(len(HDUs), rejected, len(HDUs) * height * width))
+	return combined
+
+def minMaxCombine(fileList, bias=None, nLow=1, nHigh=1, hdu=0):
+	""" Per-pixel mean of a list of FITS frames after rejecting the nLow lowest and nHigh highest values at each pixel.
+	    The frames are streamed once; only the running sum and the nLow + nHigh extreme values are kept. """
+	if len(fileList)<=nLow+nHigh:
+		raise ValueError("Need more than %d frames to reject %d low and %d high values."%(nLow+nHigh, nLow, nHigh))
+	HDULists = openFrames(fileList)
+	try:
+		HDUs = [ getImageHDU(hdul, hdu) for hdul in HDULists ]
+		total = numpy.zeros(HDUs[0].shape)
+		lows = numpy.full((nLow,) + HDUs[0].shape, numpy.inf)
+		highs = numpy.full((nHigh,) + HDUs[0].shape, -numpy.inf)
+		for HDU in HDUs:
+			imageData = readFrame(HDU, bias)
+			total+= imageData
+			# Insert the new values into the sorted lists of extremes, pushing the displaced value along
+			value = imageData
+			for k in range(nLow):
+				lower = numpy.minimum(lows[k], value)
+				value = numpy.maximum(lows[k], value)
+				lows[k] = lower
+			value = imageData
+			for k in range(nHigh):
+				higher = numpy.maximum(highs[k], value)
+				value = numpy.minimum(highs[k], value)
+				highs[k] = higher
+	finally:
+		closeFrames(HDULists)
+	total-= numpy.sum(lows, axis=0)
+	total-= numpy.sum(highs, axis=0)
+	total/= len(HDUs) - nLow - nHigh
+	return total
+
+combineMethods = ['median', 'sigmaclip', 'minmax']
+
+def combineFrames(fileList, method="median", bias=None, memoryLimit=defaultMemoryLimit, sigma=3.0, nLow=1, nHigh=1, hdu=0):
+	""" Combines a list of FITS frames into a single frame using one of the methods in combineMethods. """
+	if method=="median": return medianCombine(fileList, bias=bias, memoryLimit=memoryLimit, hdu=hdu)
+	if method=="sigmaclip": return clippedMeanCombine(fileList, bias=bias, sigma=sigma, hdu=hdu, memoryLimit=memoryLimit)
+	if method=="minmax": return minMaxCombine(fileList, bias=bias, nLow=nLow, nHigh=nHigh, hdu=hdu)
+	raise ValueError("Unknown combine method: %s"%method)
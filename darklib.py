@@ -0,0 +1,65 @@
+import numpy
+import astropy.io.fits
+
+class darkModel:
+	""" Per-pixel linear dark model, counts = offset + rate x exptime, fitted by least squares to a series of darks with different exposure times.
+	    Frames are added one at a time and only the running sums are kept, so memory use does not depend on the number of darks. """
+	def __init__(self):
+		self.n = 0
+		self.sumT = 0.0
+		self.sumTT = 0.0
+		self.sumC = None
+		self.sumTC = None
+		self.minExpTime = None
+		self.maxExpTime = None
+		self.rate = None
+		self.offset = None
+
+	def add(self, imageData, expTime):
+		expTime = float(expTime)
+		if self.sumC is None:
+			self.sumC = numpy.zeros(numpy.shape(imageData))
+			self.sumTC = numpy.zeros(numpy.shape(imageData))
+		if self.n==0: self.minExpTime, self.maxExpTime = expTime, expTime
+		self.minExpTime = min(self.minExpTime, expTime)
+		self.maxExpTime = max(self.maxExpTime, expTime)
+		self.n+= 1
+		self.sumT+= expTime
+		self.sumTT+= expTime * expTime
+		self.sumC+= imageData
+		self.sumTC+= expTime * numpy.asarray(imageData, dtype=numpy.float64)
+
+	def solve(self):
+		""" Computes the rate (ADU/s) and offset (ADU) maps from the accumulated sums. """
+		denominator = self.n * self.sumTT - self.sumT * self.sumT
+		if self.n<2 or denominator<=0:
+			raise ValueError("Need darks with at least two different exposure times to fit a dark model.")
+		self.rate = self.sumTC * self.n
+		self.rate-= self.sumT * self.sumC
+		self.rate/= denominator
+		self.offset = self.sumC - self.sumT * self.rate
+		self.offset/= self.n
+		return self.rate, self.offset
+
+	def getDark(self, expTime):
+		""" Synthesises a dark frame for the given exposure time. """
+		if self.rate is None: self.solve()
+		return self.offset + self.rate * float(expTime)
+
+	def save(self, filename):
+		if self.rate is None: self.solve()
+		primary = astropy.io.fits.PrimaryHDU()
+		primary.header['NDARKS'] = (self.n, "Number of darks in the fit")
+		primary.header['MINEXP'] = (self.minExpTime, "Shortest exposure time (s)")
+		primary.header['MAXEXP'] = (self.maxExpTime, "Longest exposure time (s)")
+		offset = astropy.io.fits.ImageHDU(self.offset.astype(numpy.float32), name='OFFSET')
+		rate = astropy.io.fits.ImageHDU(self.rate.astype(numpy.float32), name='RATE')
+		rate.header['BUNIT'] = 'ADU/s'
+		astropy.io.fits.HDUList([primary, offset, rate]).writeto(filename, overwrite=True)
+
+	def load(self, filename):
+		hdul = astropy.io.fits.open(filename)
+		self.offset = hdul['OFFSET'].data.astype(numpy.float64)
+		self.rate = hdul['RATE'].data.astype(numpy.float64)
+		self.n = hdul[0].header.get('NDARKS', 0)
+		hdul.close()
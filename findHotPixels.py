@@ -4,8 +4,12 @@ import matplotlib.pyplot
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
 import astropy
 import subprocess
+import loaderlib
+import darklib
+import statslib
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a FITS file and looks for hot pixels.')
@@ -16,6 +20,8 @@ if __name__ == "__main__":
 	parser.add_argument('--sigmafactor', type=int, default=10, help="n x sigma from the media will mean a bright pixel. Default is 10.")
 	parser.add_argument('--noplot', action="store_true", help="Skips the plots.")
 	parser.add_argument('--list', action="store_true", help="Filename is a text file with a list of files to be analysed.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
+	parser.add_argument('--darkmodel', type=str, help="Fit a per-pixel dark model (offset + rate x exptime) to the files and write the offset and rate maps to this FITS file.")
 	parser.add_argument('-o', '--output', type=str, default="auto", help="Name of the output mask file. By default it will create filename of the form [camera]_[exp]_[bin].fits.gz.")
 	
 	#parser.add_argument('-p', '--pause', type=float, default=0.25, help="Number of seconds to pause on each plot.")
@@ -38,6 +44,7 @@ if __name__ == "__main__":
 	print(arg)
 
 	pixelDB = []
+	if arg.darkmodel is not None: dark = darklib.darkModel()
 
 	if arg.list:
 		FITSFilenames = []
@@ -51,10 +58,8 @@ if __name__ == "__main__":
 
 	print("Files to load:",FITSFilenames)
 
-	for index, FITSfile in enumerate(FITSFilenames):
-		if not arg.noplot: matplotlib.pyplot.figure(figsize=(10,10/1.62))
-		hdul = astropy.io.fits.open(FITSfile)
-		header = hdul[0].header
+	commonPacked = None		# Running AND of the hot pixel masks, 8 pixels per byte
+	for index, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(FITSFilenames, workers=arg.workers)):
 		expTime = "unknown"
 		binning = "unknown"
 		try:
@@ -62,52 +67,52 @@ if __name__ == "__main__":
 			binning = header['CCDSUM']
 		except KeyError:
 			continue
-		imageData = hdul[0].data
+		if not arg.noplot: matplotlib.pyplot.figure(figsize=(10,10/1.62))
 		# Subtract the bias
 		if arg.bias is not None: imageData = imageData - bias
+		if arg.darkmodel is not None:
+			if dark.sumC is not None and numpy.shape(imageData)!=numpy.shape(dark.sumC):
+				print("%s has dimensions %s, not %s. Skipping it for the dark model."%(FITSfile, numpy.shape(imageData), numpy.shape(dark.sumC)))
+			else: dark.add(imageData, expTime)
 		
 		# Count the number of saturated pixels
-		saturatedPixels = numpy.where(imageData == saturation)
-		saturatedMask = numpy.array(imageData == saturation)
-		pixels_x = []
-		pixels_y = []
-		colors = []
-		for y, x in zip(saturatedPixels[0], saturatedPixels[1]):
-			pixels_x.append(x)
-			pixels_y.append(y)
-			colors.append('r')
+		saturatedMask = imageData == saturation
+		saturated_y, saturated_x = numpy.nonzero(saturatedMask)
 
-		numSaturated = len(pixels_x)
+		numSaturated = len(saturated_x)
 		dimensions = numpy.shape(imageData)
 		totalPixels = numpy.shape(imageData)[0] * numpy.shape(imageData)[1]
 		print("Image contains %d pixels."%totalPixels)
 		print("Image contains %d saturated pixels."%numSaturated)
-		median = numpy.median(imageData)
-		stddev = numpy.std(imageData)
+		frameStats = statslib.histogram(imageData, binWidth=0.5, saturation=saturation)
+		median = frameStats.median()
+		stddev = frameStats.std()
 		print("median pixel value is %d ADU with a stdev of %.2f."%(median, stddev))
 		medianClip = median + sigmaFactor*stddev
-		brightPixels = numpy.where((imageData > medianClip) & (imageData !=saturation))
-		brightMask = numpy.array((imageData > medianClip))
-		numBright = len(brightPixels[0])
-		for y, x in zip(brightPixels[0], brightPixels[1]):
-			pixels_x.append(x)
-			pixels_y.append(y)
-			colors.append('y')
+		brightMask = imageData > medianClip
+		bright_y, bright_x = numpy.nonzero(brightMask & ~saturatedMask)
+		numBright = len(bright_x)
 		print("%d pixels brighter than %.2f ADU which is %d times sigma above the median."%(numBright, medianClip,sigmaFactor))
 		
 		print("total hot pixels: %d, hot pixel fraction is %f%% where the exposure time is: %f"%((numBright+numSaturated), 100*(numBright+numSaturated)/totalPixels, expTime))
 
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
 		if not arg.noplot: 
+			amplifiedImage = stretchlib.stretch(imageData, 5, 95)
 			matplotlib.pyplot.imshow(amplifiedImage)
 			matplotlib.pyplot.gca().invert_yaxis()
 			# Draw circles around hot pixels
-			from matplotlib.patches import Circle
-			for xx,yy,cc in zip(pixels_x,pixels_y, colors):
-				circ = Circle((xx,yy),5, edgecolor=cc, fill=False)
-				matplotlib.pyplot.gca().add_patch(circ)	
+			matplotlib.pyplot.scatter(saturated_x, saturated_y, s=100, facecolors='none', edgecolors='r')
+			matplotlib.pyplot.scatter(bright_x, bright_y, s=100, facecolors='none', edgecolors='y')
 
 		hotPixelMask = brightMask | saturatedMask
+		if commonPacked is None: 
+			maskShape = dimensions
+			maskHeader = header
+			commonPacked = numpy.packbits(hotPixelMask)
+		elif dimensions!=maskShape:
+			print("%s has dimensions %s, not %s. Skipping it for the common hot pixels."%(FITSfile, dimensions, maskShape))
+		else:
+			commonPacked&= numpy.packbits(hotPixelMask)
 
 		if not arg.noplot: 
 			if arg.save:
@@ -119,45 +124,49 @@ if __name__ == "__main__":
 		print("Dumping pixel list to: %s"%pixelFile)
 		pixelWriter = open(pixelFile, 'wt')
 		pixelWriter.write("# filename: %s\n# exptime: %f\n# binning: %s\n"%(FITSfile, expTime, binning))
-		for x, y in zip(pixels_x, pixels_y):
-			pixelWriter.write("%d, %d\n"%(x, y))
+		pixels = numpy.column_stack((numpy.concatenate((saturated_x, bright_x)), numpy.concatenate((saturated_y, bright_y))))
+		numpy.savetxt(pixelWriter, pixels, fmt="%d", delimiter=", ")
 		pixelWriter.close()	
 
 		# Add to the pixelDB
-		pixelEntry = { "filename": FITSfile, "expTime": expTime, "binning": binning, "x": pixels_x, "y": pixels_y, "hotPixels": hotPixelMask }
+		pixelEntry = { "filename": FITSfile, "expTime": expTime, "binning": binning, "saturated": numSaturated, "bright": numBright }
 		pixelDB.append(pixelEntry)
 		print()
 
 	# Compute common hot pixels
-	overallMask = pixelDB[0]['hotPixels']
-	for index in range(1, len(pixelDB)):
-		overallMask = overallMask & pixelDB[index]['hotPixels']
+	overallMask = numpy.unpackbits(commonPacked, count=maskShape[0]*maskShape[1]).reshape(maskShape).view(bool)
 
 	numHotPixels = numpy.sum(overallMask)
 	print("Hot pixels common to all images: %d"%numHotPixels)
-	commonPixels = numpy.where(overallMask)
+	commonPixels = numpy.nonzero(overallMask)
 	pixels_x = commonPixels[1]
 	pixels_y = commonPixels[0]
 	# Dump hot pixels to a text file
 	pixelFile = "hotpixels.dat"
 	print("Dumping pixel list to: %s"%pixelFile)
-	pixelWriter = open(pixelFile, 'wt')
-	for x, y in zip(pixels_x, pixels_y):
-		pixelWriter.write("%d, %d\n"%(x, y))
-	pixelWriter.close()	
+	numpy.savetxt(pixelFile, numpy.column_stack((pixels_x, pixels_y)), fmt="%d", delimiter=", ")
 	
 	# Write the pixel mask to a FITS file
-	ones = overallMask * 1.0
 	if arg.output=="auto":
 		filename = os.path.splitext(FITSfile)[0] + "_mask.fits.gz" 
 	else:
 		filename = arg.output 
 	fitsmask = filename
-	maskdump = numpy.array(ones, dtype=int)
+	maskdump = overallMask.astype(int)
 	print("Dumping mask to %s"%fitsmask)
 	print(numpy.shape(maskdump))
+	# Record the binning so that the mask can be cut to match other frames
 	hdu = astropy.io.fits.PrimaryHDU(maskdump)
+	for keyword in ['CCDSUM', 'CCDXBIN', 'CCDYBIN']:
+		if keyword in maskHeader: hdu.header[keyword] = maskHeader[keyword]
 	hdul = astropy.io.fits.HDUList([hdu])
 	hdul.writeto(fitsmask, overwrite=True)
+
+	if arg.darkmodel is not None:
+		rate, offset = dark.solve()
+		print("Dark model from %d frames with exposure times %.1f to %.1f s."%(dark.n, dark.minExpTime, dark.maxExpTime))
+		print("median dark current is %.3f ADU/s with a median offset of %.1f ADU."%(numpy.median(rate), numpy.median(offset)))
+		print("Dumping dark model to %s"%arg.darkmodel)
+		dark.save(arg.darkmodel)
 	
 	sys.exit()
@@ -1,5 +1,4 @@
-import math, numpy, os, sys
-from PIL import Image,ImageDraw,ImageFont
+import math, os, sys
 
 
 def setMatplotlibDefaults():
@@ -15,20 +14,6 @@ def setMatplotlibDefaults():
 			}
 	matplotlib.rcParams.update(params)
 
-def percentiles(data, lo, hi):
-    """ Returns a normalised array where lo percent of the pixels are 0 and hi percent of the pixels are 255
-    """
-    max = data.max()
-    dataArray = data.flatten()
-    pHi = numpy.percentile(dataArray, hi)
-    pLo = numpy.percentile(dataArray, lo)
-    range = pHi - pLo
-    scale = range/255
-    data = numpy.clip(data, pLo, pHi)
-    data-= pLo
-    data/=scale
-    return data
-
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
 
@@ -90,32 +75,10 @@ def addSuffixToFilename(filename, suffix):
 	
 def writePNG(imageArray, filename, caption = ""):
 	""" Writes to a PNG file using the PIL library. Adds a caption if sent in the parameters. Also adds a .png extension if it isn't already there in 'filename' """
-	imgData = numpy.rot90(imageArray, 3)
-	imgSize = numpy.shape(imgData)
-	imgLength = imgSize[0] * imgSize[1]
-	testData = numpy.reshape(imgData, imgLength, order="F")
-	img = Image.new("L", imgSize)
-	palette = []
-	for i in range(256):
-		palette.extend((i, i, i)) # grey scale
-		img.putpalette(palette)
-	img.putdata(testData)
+	import thumbnaillib
 	outputFilename = changeExtension(filename, "png")
 	print ("Writing PNG file: " + outputFilename) 
-	img.save(outputFilename, "PNG", clobber=True)
-	
-	"""image = Image.fromarray(imageArray)
-	imageCopy = image.copy()    # We need to copy the image so we don't alter the original when adding the caption.
-	if (caption!=""): 
-		font = ImageFont.truetype(config.FONT, 25) 
-		draw = ImageDraw.Draw(imageCopy)
-		if (imageCopy.mode == "L"):
-			draw.text((0, 0), caption, 255, font = font)
-		else: 
-			draw.text((0, 0), caption, (255, 255, 255), font = font)
-	
-	if (filename[-4:]!=".png"): filename+= ".png"
-	imageCopy.save(filename, "PNG")"""
+	thumbnaillib.toImage(imageArray, caption=caption).save(outputFilename, "PNG")
 	
 def toSexagesimal(world):
 	raDeg = world[0]
@@ -196,11 +159,8 @@ def parseIntegerList(line):
 	return intList
 	
 def removeDuplicatesFromList(list):
-	newList = []
-	for index, l in enumerate(list):
-		if l not in list[:index]:
-			newList.append(l)
-	return newList
+	""" Returns the list without repeated items, keeping the first occurrence of each. """
+	return [ l for l in dict.fromkeys(list) ]
 	
 def getBetweenChars(inputString, startChar, endChar):
 	""" Gets a portion of a string between two characters """
@@ -0,0 +1,156 @@
+import concurrent.futures, gzip, os
+import loaderlib
+
+blockSize = 2880
+cardLength = 80
+commentaryKeywords = ['COMMENT', 'HISTORY', '']
+# Keywords of a tile-compressed image's binary table that describe the table rather than the image
+compressionKeywords = ['XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT', 'GCOUNT', 'TFIELDS', 'THEAP', 'ZIMAGE', 'ZCMPTYPE', 'ZBITPIX', 'ZNAXIS', 'ZSIMPLE', 'ZEXTEND', 'ZBLOCKED', 'ZTENSION', 'ZPCOUNT', 'ZGCOUNT', 'ZQUANTIZ', 'ZDITHER0', 'ZHECKSUM', 'ZDATASUM']
+compressionPrefixes = ['TTYPE', 'TFORM', 'TUNIT', 'TSCAL', 'TZERO', 'TNULL', 'TDIM', 'TDISP', 'ZNAXIS', 'ZTILE', 'ZNAME', 'ZVAL']
+
+def parseValue(valueString):
+	""" Converts the value field of a card (the text after '= ' with the comment removed) to a str, bool, int, float or None. """
+	valueString = valueString.strip()
+	if len(valueString)==0: return None
+	if valueString=='T': return True
+	if valueString=='F': return False
+	try:
+		return int(valueString)
+	except ValueError:
+		pass
+	try:
+		return float(valueString.replace('D', 'E'))
+	except ValueError:
+		return valueString
+
+def parseCard(card):
+	""" Splits an 80-character card into (keyword, value, comment). Commentary cards (COMMENT, HISTORY, blank) have their text as the value.
+	    CONTINUE cards (the rest of a long string) have the string as the value. """
+	keyword = card[:8].strip()
+	field = card[10:]
+	if keyword=='HIERARCH' and '=' in card:
+		keyword, field = card[9:].split('=', 1)
+		keyword = keyword.strip()
+	elif keyword=='CONTINUE' and card[8:].lstrip().startswith("'"):
+		field = card[8:]
+	elif card[8:10]!='= ' or keyword in commentaryKeywords:
+		return keyword, card[8:].rstrip(), ""
+	if field.lstrip().startswith("'"):
+		# A string: '' inside the quotes is a literal quote, trailing spaces are not significant
+		start = field.index("'") + 1
+		position = start
+		while True:
+			end = field.find("'", position)
+			if end==-1: return keyword, field[start:].rstrip(), ""
+			if field[end+1:end+2]!="'": break
+			position = end + 2
+		value = field[start:end].replace("''", "'").rstrip()
+		comment = field[end+1:]
+		comment = comment[comment.find('/')+1:].strip() if '/' in comment else ""
+		return keyword, value, comment
+	if '/' in field:
+		field, comment = field.split('/', 1)
+		return keyword, parseValue(field), comment.strip()
+	return keyword, parseValue(field), ""
+
+def openFITS(filename):
+	""" Opens a FITS file for reading raw bytes. Gzipped files are inflated as they are read, so only the blocks that are read are inflated. """
+	rawFile = open(filename, 'rb')
+	magic = rawFile.read(2)
+	rawFile.seek(0)
+	if magic==b'\x1f\x8b': return gzip.GzipFile(fileobj=rawFile, mode='rb')
+	return rawFile
+
+def readHeaderBlocks(FITSFile):
+	""" Reads 2880-byte blocks from the current position up to and including the one with the END card. Returns the cards, or None at the end of the file. """
+	cards = []
+	while True:
+		block = FITSFile.read(blockSize)
+		if len(block)<blockSize: return None
+		text = block.decode('ascii', errors='replace')
+		for position in range(0, blockSize, cardLength):
+			card = text[position:position+cardLength]
+			if card[:8]=='END     ': return cards
+			cards.append(card)
+
+def cardsToDictionary(cards):
+	""" Typed header values by keyword. Repeated commentary keywords (COMMENT, HISTORY) are collected into a list of strings.
+	    Long strings continued on CONTINUE cards (the FITS long-string convention) are joined, without the '&' at the end of each part. """
+	header = {}
+	previous = None
+	for card in cards:
+		keyword, value, comment = parseCard(card)
+		if keyword=='CONTINUE':
+			if previous is not None and isinstance(header[previous], str) and header[previous].endswith('&') and isinstance(value, str):
+				header[previous] = header[previous][:-1] + value
+			continue
+		previous = None
+		if keyword in commentaryKeywords:
+			if keyword=='': continue
+			header.setdefault(keyword, []).append(value)
+			continue
+		header[keyword] = value
+		previous = keyword
+	return header
+
+def imageHeader(header):
+	""" The header of the image in a tile-compressed (.fz) HDU, as astropy shows it: the Z keywords give the image's BITPIX and axes,
+	    and the keywords describing the binary table are left out. Other headers are returned unchanged. """
+	if header.get('ZIMAGE') is not True: return header
+	image = { 'XTENSION': 'IMAGE', 'BITPIX': header.get('ZBITPIX'), 'NAXIS': header.get('ZNAXIS', 0) }
+	for axis in range(1, image['NAXIS']+1):
+		image['NAXIS%d'%axis] = header.get('ZNAXIS%d'%axis)
+	image['PCOUNT'] = header.get('ZPCOUNT', 0)
+	image['GCOUNT'] = header.get('ZGCOUNT', 1)
+	for keyword, value in header.items():
+		if keyword in compressionKeywords: continue
+		if keyword=='EXTNAME' and value=='COMPRESSED_IMAGE': continue		# astropy's default name for the table
+		if any(keyword.startswith(prefix) and keyword[len(prefix):].isdigit() for prefix in compressionPrefixes): continue
+		image[keyword] = value
+	return image
+
+def getDataSize(header):
+	""" Number of bytes (padded to whole blocks) of the data following a header. """
+	naxis = header.get('NAXIS', 0)
+	if naxis==0: return 0
+	elements = 1
+	for axis in range(1, naxis+1):
+		elements*= header.get('NAXIS%d'%axis, 0)
+	bits = abs(header.get('BITPIX', 8)) * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + elements)
+	size = bits // 8
+	return ((size + blockSize - 1) // blockSize) * blockSize
+
+def readHeaders(filename, maxHDUs=None):
+	""" Returns a list of header dictionaries, one per HDU, reading only the header blocks and skipping over the data. """
+	headers = []
+	FITSFile = openFITS(filename)
+	try:
+		while maxHDUs is None or len(headers)<maxHDUs:
+			cards = readHeaderBlocks(FITSFile)
+			if cards is None: break
+			header = cardsToDictionary(cards)
+			headers.append(imageHeader(header))
+			dataSize = getDataSize(header)
+			if dataSize>0: FITSFile.seek(dataSize, os.SEEK_CUR)
+	finally:
+		FITSFile.close()
+	return headers
+
+def readHeader(filename, hdu=0):
+	""" The header of one HDU as a dictionary of typed values, a fast replacement for copying hdul[hdu].header into a dictionary. """
+	headers = readHeaders(filename, maxHDUs=hdu+1)
+	if len(headers)<=hdu: raise IndexError("%s has no HDU %d"%(filename, hdu))
+	return headers[hdu]
+
+def scanHeaders(fileList, maxHDUs=None, workers=loaderlib.defaultWorkers):
+	""" Generator of (filename, list of header dictionaries) for a list of FITS files, read in a pool of threads, in list order. """
+	if workers<1:
+		for filename in fileList: yield filename, readHeaders(filename, maxHDUs)
+		return
+	fileList = list(fileList)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	try:
+		for filename, headers in zip(fileList, executor.map(readHeaders, fileList, [maxHDUs]*len(fileList))):
+			yield filename, headers
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import argparse, os, re, sys, time
+import loaderlib
+import indexlib
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Keeps an index (SQLite) of selected FITS headers for the files in a folder and selects frames from it.')
+	parser.add_argument('folder', type=str, nargs='?', default=".", help="Folder with the FITS files. Default is the current folder.")
+	parser.add_argument('-i', '--index', type=str, help="Index filename. Default is headers.db in the folder.")
+	parser.add_argument('-k', '--keywords', nargs='+', type=str, help="Extra header keywords to index.")
+	parser.add_argument('--ext', type=str, default='.*.(fits|fits.gz|fits.fz|fit)', help="FITS file descriptor: Pattern to match in filenames. Default is '.*.(fits|fits.gz|fits.fz|fit)'")
+	parser.add_argument('-w', '--where', type=str, help="List the files matching this SQL condition on the indexed headers, eg \"EXPTIME>5 AND FILTER='R'\".")
+	parser.add_argument('-s', '--show', nargs='+', type=str, help="Headers to show next to the selected filenames.")
+	parser.add_argument('-o', '--output', type=str, help="Write the selected filenames to this file (a list for the reduction scripts).")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to read new headers. Default is %d."%loaderlib.defaultWorkers)
+	arg = parser.parse_args()
+
+	search_re = re.compile(arg.ext)
+	FITSFilenames = sorted([ os.path.join(arg.folder, f) for f in os.listdir(arg.folder) if search_re.match(f) ])
+	indexFilename = arg.index
+	if indexFilename is None: indexFilename = os.path.join(arg.folder, "headers.db")
+
+	startTime = time.time()
+	index = indexlib.headerIndex(indexFilename, arg.keywords)
+	updated = index.update(FITSFilenames, workers=arg.workers)
+	removed = index.prune(FITSFilenames) if arg.index is None else index.prune()
+	print("%s: %d files, %d read, %d removed in %.2f seconds."%(indexFilename, len(FITSFilenames), updated, removed, time.time() - startTime), file=sys.stderr)
+
+	if arg.where is None and arg.output is None and arg.show is None: sys.exit()
+	show = arg.show if arg.show is not None else []
+	rows = index.query(show, where=arg.where)
+	for row in rows:
+		print("\t".join([row['path']] + [ str(row[k]) for k in show ]))
+	if arg.output is not None:
+		outputFile = open(arg.output, 'wt')
+		for row in rows:
+			outputFile.write(row['path'] + "\n")
+		outputFile.close()
+		print("Written %d filenames to %s"%(len(rows), arg.output), file=sys.stderr)
@@ -0,0 +1,123 @@
+import os, sqlite3, sys
+import headerlib
+import loaderlib
+
+def quote(keyword):
+	""" Quotes a header keyword (eg DATE-OBS) for use as an SQL column name. """
+	return '"%s"'%keyword.replace('"', '""')
+
+class headerIndex:
+	""" An SQLite table of selected header keywords for a set of FITS files, one row per file and one column per keyword.
+	    Files are only re-read when their modification time or size changes, and new files are scanned in parallel.
+	    The keyword value is taken from the first HDU that has it. Frames can be selected with an SQL WHERE clause on the keywords,
+	    eg "EXPTIME>5 AND FILTER='R'" (quote keywords with a '-' in them, eg "DATE-OBS").
+	    Paths are stored relative to the folder of the index, so the same file has one row however it was named (eg r1.fits or ./r1.fits)
+	    and the index still works if the folder is moved. """
+	defaultKeywords = ['OBJECT', 'FILTER', 'EXPTIME', 'JD', 'DATE-OBS', 'UTSTART', 'RUN', 'IMAGETYP', 'CCDSUM', 'CCDXBIN', 'CCDYBIN', 'CCDSPEED', 'WINSEC4', 'INSTRUME']
+	fileColumns = ['path', 'mtime', 'size']
+
+	def __init__(self, filename="headers.db", keywords=None):
+		self.filename = filename
+		self.folder = os.path.dirname(os.path.abspath(filename))
+		self.connection = sqlite3.connect(filename)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)")
+		self.connection.commit()
+		if len(self.getKeywords())==0: self.addKeywords(headerIndex.defaultKeywords)
+		if keywords is not None: self.addKeywords(keywords)
+
+	def getKey(self, path):
+		""" The path of a file as stored in the index. """
+		return os.path.relpath(os.path.abspath(path), self.folder)
+
+	def getPath(self, key):
+		""" The path of an indexed file relative to the current folder. """
+		return os.path.relpath(os.path.join(self.folder, key))
+
+	def getKeywords(self):
+		columns = [ row['name'] for row in self.connection.execute("PRAGMA table_info(files)") ]
+		return [ c for c in columns if c not in headerIndex.fileColumns ]
+
+	def addKeywords(self, keywords):
+		""" Adds columns for keywords not indexed yet. Every file is then re-read on the next update. """
+		newKeywords = [ k.upper() for k in keywords if k.upper() not in self.getKeywords() ]
+		if len(newKeywords)==0: return
+		with self.connection:
+			for keyword in newKeywords:
+				self.connection.execute("ALTER TABLE files ADD COLUMN %s"%quote(keyword))
+			self.connection.execute("UPDATE files SET mtime=-1")
+		print("Indexing the keywords:", ", ".join(newKeywords), file=sys.stderr)
+
+	def update(self, fileList, workers=loaderlib.defaultWorkers):
+		""" Brings the index up to date for the files in the list. Returns the number of files that were (re-)read. """
+		known = { row['path']: (row['mtime'], row['size']) for row in self.connection.execute("SELECT path, mtime, size FROM files") }
+		stale = []
+		for path in fileList:
+			status = os.stat(path)
+			key = self.getKey(path)
+			if known.get(key)!=(status.st_mtime, status.st_size): stale.append((path, status.st_mtime, status.st_size))
+		if len(stale)==0: return 0
+		keywords = self.getKeywords()
+		columns = headerIndex.fileColumns + keywords
+		insert = "INSERT OR REPLACE INTO files (%s) VALUES (%s)"%(", ".join([ quote(c) for c in columns ]), ", ".join(["?"]*len(columns)))
+		rows = []
+		for (path, mtime, size), (filename, headers) in zip(stale, headerlib.scanHeaders([ s[0] for s in stale ], workers=workers)):
+			row = [self.getKey(path), mtime, size]
+			for keyword in keywords:
+				value = None
+				for header in headers:
+					if keyword in header:
+						value = header[keyword]
+						break
+				if isinstance(value, list): value = "\n".join(value)
+				row.append(value)
+			rows.append(row)
+		with self.connection:
+			self.connection.executemany(insert, rows)
+		return len(rows)
+
+	def prune(self, fileList=None):
+		""" Removes files that no longer exist (or, if a list is given, that are not in it). """
+		paths = [ row['path'] for row in self.connection.execute("SELECT path FROM files") ]
+		if fileList is None: gone = [ p for p in paths if not os.path.exists(os.path.join(self.folder, p)) ]
+		else:
+			keep = set([ self.getKey(f) for f in fileList ])
+			gone = [ p for p in paths if p not in keep ]
+		with self.connection:
+			self.connection.executemany("DELETE FROM files WHERE path=?", [ (p, ) for p in gone ])
+		return len(gone)
+
+	def query(self, keywords=None, where=None, paths=None):
+		""" Returns rows (dictionaries, indexed by keyword) with the path and the requested keywords for the files matching the WHERE clause,
+		    optionally restricted to a list of paths, in path order. The paths are returned as given in the list, or else relative to the current folder. """
+		if keywords is None: keywords = self.getKeywords()
+		else: self.checkKeywords(keywords)
+		query = "SELECT %s FROM files"%", ".join([ quote(c) for c in ['path'] + list(keywords) ])
+		conditions = []
+		if where is not None and len(where.strip())>0: conditions.append("(%s)"%where)
+		given = {}
+		if paths is not None:
+			given = { self.getKey(p): p for p in paths }
+			self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selection (path TEXT PRIMARY KEY)")
+			self.connection.execute("DELETE FROM selection")
+			self.connection.executemany("INSERT OR IGNORE INTO selection VALUES (?)", [ (k, ) for k in given ])
+			conditions.append("path IN (SELECT path FROM selection)")
+		if len(conditions)>0: query+= " WHERE " + " AND ".join(conditions)
+		rows = []
+		for row in self.connection.execute(query + " ORDER BY path"):
+			row = dict(row)
+			row['path'] = given.get(row['path']) or self.getPath(row['path'])
+			rows.append(row)
+		return rows
+
+	def select(self, where, paths=None):
+		""" Returns the paths of the files matching an SQL WHERE clause on the indexed keywords. """
+		return [ row['path'] for row in self.query([], where, paths) ]
+
+	def checkKeywords(self, keywords):
+		missing = [ k for k in keywords if k not in self.getKeywords() ]
+		if len(missing)>0: raise KeyError("Keywords not in the index %s: %s"%(self.filename, ", ".join(missing)))
+
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,39 @@
+import collections, concurrent.futures, itertools, os
+import astropy.io.fits
+
+defaultWorkers = min(8, os.cpu_count() or 1)
+
+def loadFrame(FITSfile, hdu=0):
+	""" Opens a FITS file and returns (filename, header, imageData) with the data fully decoded into memory. """
+	hdul = astropy.io.fits.open(FITSfile, memmap=False)
+	header = hdul[0].header
+	imageData = hdul[hdu].data
+	hdul.close()
+	return FITSfile, header, imageData
+
+def loadFrames(fileList, hdu=0, workers=defaultWorkers, readAhead=None, processes=False):
+	""" Generator that loads a list of FITS files in a pool of threads (or processes) and yields (filename, header, imageData) in list order.
+	    At most readAhead frames (default: twice the number of workers) are decoded ahead of the one being processed, so memory use stays bounded.
+	    A drop-in for the 'for FITSfile in fileList' loop, eg
+	        for frameNo, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList)):
+	    With workers < 1 the frames are loaded serially in the calling thread. """
+	if workers<1:
+		for FITSfile in fileList:
+			yield loadFrame(FITSfile, hdu)
+		return
+	if readAhead is None: readAhead = 2 * workers
+	if processes: executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+	else: executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	pending = collections.deque()
+	remaining = iter(fileList)
+	try:
+		for FITSfile in itertools.islice(remaining, max(1, readAhead)):
+			pending.append(executor.submit(loadFrame, FITSfile, hdu))
+		while len(pending)>0:
+			frame = pending.popleft().result()
+			for FITSfile in itertools.islice(remaining, 1):
+				pending.append(executor.submit(loadFrame, FITSfile, hdu))
+			yield frame
+	finally:
+		# Stop any read-ahead if the caller breaks out of the loop early
+		executor.shutdown(wait=True, cancel_futures=True)
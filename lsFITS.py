@@ -4,7 +4,8 @@ import argparse
 import sys, subprocess, os
 import json, re
 import datetime
-from astropy.io import fits
+import headerlib
+import indexlib
 
 def getUserHome():
 	homeDir = os.path.expanduser('~')
@@ -20,6 +21,8 @@ if __name__ == "__main__":
 	parser.add_argument('--list', type=str, help="List of files to be checked.")
 	parser.add_argument('-fh', '--FITSheader', nargs='+', type=str, help="The FITS header to look for.")
 	parser.add_argument('--ext', type=str, default='.*.(fits|fits.gz|fits.fz|fit)', help="FITS file descriptor: Pattern to match in filenames. Default is '.*.(fits|fits.gz|fits.fz|fit)'")
+	parser.add_argument('--index', type=str, help="Header index (SQLite) to answer --FITSheader from. It is created or brought up to date first.")
+	parser.add_argument('--where', type=str, help="Only list files matching this SQL condition on the indexed headers, eg \"EXPTIME>5 AND FILTER='R'\". Needs --index.")
 	parser.add_argument('--debug', action="store_true", help="Output debug information")
 	
 	args = parser.parse_args()
@@ -73,11 +76,25 @@ if __name__ == "__main__":
 	
 	headerList = []
 
-	for f in FITSFilenames:
+	if args.where is not None and args.index is None:
+		print("--where needs a header index (--index).")
+		sys.exit()
+
+	if args.index is not None:
+		index = indexlib.headerIndex(args.index)
+		if FITSheaders!='all': index.addKeywords(FITSheaders)
+		updated = index.update(FITSFilenames)
+		if debug: print("Re-read the headers of %d files."%updated)
+		keywords = index.getKeywords() if FITSheaders=='all' else [ k.upper() for k in FITSheaders ]
+		for row in index.query(keywords, where=args.where, paths=FITSFilenames):
+			for key in keywords:
+				if row[key] is None: continue
+				headerList.append({ 'header': key, 'value': row[key], 'filename': row['path'] })
+		FITSFilenames = []
+
+	for f, headers in headerlib.scanHeaders(FITSFilenames):
 		if debug: print("In file:", f)
-		hdulist = fits.open(f)
-		for card in hdulist:
-			header = card.header
+		for header in headers:
 			if FITSheaders=='all':		
 				for key in header.keys():
 					if debug:print("%s\t%s"%(key, header[key]))
@@ -4,9 +4,14 @@ import matplotlib.pyplot
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
 import astropy
 import json
 import classes
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
 
 def onclick(event):
 	global ix, iy
@@ -37,30 +42,29 @@ def keypress(event):
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a list of FITS files and previews them.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to load.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
 	parser.add_argument('-n', '--nframes', type=int, default=5, help="Number of frames to average before finding targets. Default value: 5.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('-i', '--interactive', action="store_true", help="Make each plot interactive (mouse to zoom, etc).")
 	parser.add_argument('-j', '--json', type=str, help="Save to a JSON file (specify filename).")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Masters matching the frames' configuration are used when --bias or --balance is not given.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
 	arg = parser.parse_args()
 
 	blocking = False
 	if arg.interactive: blocking = True
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0] == '#': continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
 	print(fileList)
 
+	bias = None
+	balance = None
+	balanceBinning = (1, 1)
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
@@ -71,23 +75,32 @@ if __name__ == "__main__":
 		print("loading the balance frame", arg.balance)
 		hdul = astropy.io.fits.open(arg.balance)
 		balance = hdul[0].data
+		balanceBinning = calibrationlib.getBinFactors(hdul[0].header)
 		hdul.close()
 
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		libraryHeader = astropy.io.fits.getheader(fileList[0])
+		if arg.bias is None: bias = library.getMaster('bias', libraryHeader)
+	balances = None
+	if balance is not None: balances = calibrationlib.balanceCache(balance, balanceBinning)
+	elif arg.library is not None and library.getBalance(libraryHeader) is not None:
+		# Each frame gets the library's balance for its own window and binning
+		balances = calibrationlib.libraryBalances(library)
+
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause)
+
 	medianFrameStack = []	
-	for frameNo, FITSfile in enumerate(fileList):
-		hdul = astropy.io.fits.open(FITSfile)
-		# print(hdul.info())
+	for frameNo, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList[:arg.nframes], workers=arg.workers)):
 		# Put all of the headers into a dictionary object
 		FITSHeaders = {}
-		header = hdul[0].header
 		for h in header:
 			FITSHeaders[h] = header[h]
-		imageData = hdul[0].data
-		hdul.close()
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
-		if arg.balance is not None: imageData = numpy.divide(imageData, balance)
+		if balances is not None: imageData = numpy.divide(imageData, balances.get(header, numpy.shape(imageData)))
 		
 		# Build the average frame
 		if frameNo==0: average = imageData
@@ -95,19 +108,15 @@ if __name__ == "__main__":
 		medianFrameStack.append(imageData)
 		
 	
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
-		matplotlib.pyplot.show(block=False)
-		matplotlib.pyplot.pause(arg.pause)
-		matplotlib.pyplot.clf()
+		preview.submit(imageData, title=FITSfile)
 		print("Frame number: {:d}".format(frameNo))
 		if frameNo==arg.nframes-1: break
+	preview.close()
 
 	
 	average = numpy.divide(average, frameNo)
 	medianFrame = numpy.median(medianFrameStack, axis=0)
-	amplifiedImage = generallib.percentiles(medianFrame, 5, 95)
+	amplifiedImage = stretchlib.stretch(medianFrame, 5, 95)
 	
 	fig = matplotlib.pyplot.figure()
 	matplotlib.pyplot.imshow(amplifiedImage)
@@ -141,7 +150,7 @@ if __name__ == "__main__":
 
 	mouseclick = fig.canvas.mpl_connect('button_press_event', onclick)
 	keypress = fig.canvas.mpl_connect('key_press_event', keypress)	
-	matplotlib.pyplot.show(block=True)
+	if not arg.headless: matplotlib.pyplot.show(block=True)
 
 	print("Saving apertures")
 	apertureList.save()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+import argparse, time
+import loaderlib
+import selectlib
+import thumbnaillib
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Writes PNG quick-looks of a list of FITS files and a contact sheet of the whole list.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
+	parser.add_argument('-o', '--outputpath', type=str, default="thumbnails", help="Folder to write the PNG files to. Default is 'thumbnails'.")
+	parser.add_argument('-b', '--binning', type=int, default=4, help="Bin the quick-looks by this factor. Default is 4.")
+	parser.add_argument('--lo', type=float, default=5, help="Percentile shown as black. Default is 5.")
+	parser.add_argument('--hi', type=float, default=95, help="Percentile shown as white. Default is 95.")
+	parser.add_argument('--nocaption', action="store_true", help="Don't write the filename and exposure time on the quick-looks.")
+	parser.add_argument('-c', '--contactsheet', type=str, default="contactsheet.png", help="Filename for the contact sheet. Default is 'contactsheet.png'.")
+	parser.add_argument('--columns', type=int, default=10, help="Number of frames across the contact sheet. Default is 10.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of processes used to make the quick-looks. Default is %d."%loaderlib.defaultWorkers)
+	arg = parser.parse_args()
+
+	fileList = selectlib.getFileList(arg.inputfiles)
+
+	startTime = time.time()
+	thumbnailList = thumbnaillib.writeThumbnails(fileList, arg.outputpath, binning=arg.binning, lo=arg.lo, hi=arg.hi, caption=not arg.nocaption, workers=arg.workers)
+	print("Written %d quick-looks to %s in %.1f seconds."%(len(thumbnailList), arg.outputpath, time.time() - startTime))
+	if len(thumbnailList)>0: thumbnaillib.contactSheet(thumbnailList, arg.contactsheet, columns=arg.columns)
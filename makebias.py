@@ -2,33 +2,51 @@
 import argparse, sys, numpy
 import matplotlib.pyplot
 import generallib
+import combinelib
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
+import statslib
 import astropy
 import subprocess
 from astropy.io import fits
 
+def getStats(biasData, method):
+	""" Mean, median and standard deviation of a combined bias. A median of integer frames is a multiple of 0.5 ADU, so for it a 0.5 ADU
+	    histogram gives exact statistics without sorting; the other combines give arbitrary values, so they are measured directly. """
+	if method=="median":
+		biasStats = statslib.histogram(biasData, binWidth=0.5)
+		return biasStats.mean(), biasStats.median(), biasStats.std()
+	return numpy.mean(biasData), numpy.median(biasData), numpy.std(biasData)
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a list of FITS files makes a bias frame from them.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to load.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
-	parser.add_argument('-p', '--pause', type=float, default=0.5, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.5, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('-i', '--interactive', action="store_true", help="Make each plot interactive (mouse to zoom, etc).")
 	parser.add_argument("-o", "--outputfilename", type=str, help="Output filename for the bias.")
 	parser.add_argument('-j', '--json', type=str, help="Save to a JSON file (specify filename).")
 	parser.add_argument("--preview",  action="store_true", help="Preview each CCD in 'ds9'.")
+	parser.add_argument('--library', type=str, help="Also store the bias in this calibration library directory.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
+	parser.add_argument('-m', '--memory', type=int, default=2048, help="Memory (in MB) to use for the tiled median combine. Default is 2048.")
+	parser.add_argument('-c', '--combine', type=str, default="median", choices=combinelib.combineMethods, help="How to combine the frames. 'sigmaclip' is a sigma-clipped mean, 'minmax' rejects the highest and lowest values. Default is median.")
+	parser.add_argument('--sigma', type=float, default=3.0, help="Rejection threshold (in standard deviations) for the 'sigmaclip' combine. Default is 3.")
+	parser.add_argument('--nlow', type=int, default=1, help="Number of low values to reject for the 'minmax' combine. Default is 1.")
+	parser.add_argument('--nhigh', type=int, default=1, help="Number of high values to reject for the 'minmax' combine. Default is 1.")
 	arg = parser.parse_args()
 
 	blocking = False
 	if arg.interactive: blocking = True
-	numCCDs = 1
 
-	fileList = []
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause)
+	numCCDs = 1
 
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0] == '#': continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
 	print("Number of files to process for bias is", len(fileList))
 
@@ -55,43 +73,32 @@ if __name__ == "__main__":
 	#print("CCDYBIN", CCDYBIN)
 	#print("RSPEED", RSPEED)
 
-	biasFrames = []
-	for index, FITSfile in enumerate(fileList):
+	for index, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList, workers=arg.workers)):
 		frameNo = index+1
 		print("Frame no: %d"%(frameNo))
-		hdul = astropy.io.fits.open(FITSfile)
-		imageData = hdul[0].data
-		biasFrames.append(imageData)
-		hdul.close()
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
-		matplotlib.pyplot.show(block=False)
-		matplotlib.pyplot.pause(0.01)
-		matplotlib.pyplot.clf() #clears figure
+		preview.submit(imageData, title=FITSfile)
+	preview.close()
 		
-	biasData = numpy.median(biasFrames, axis = 0)
+	biasData = combinelib.combineFrames(fileList, method=arg.combine, memoryLimit=arg.memory*1024**2, sigma=arg.sigma, nLow=arg.nlow, nHigh=arg.nhigh)
 	matplotlib.pyplot.imshow(biasData)
 	matplotlib.pyplot.show(block=False)
-	print("Number of bias frames used: ", len(biasFrames))
+	print("Number of bias frames used: ", len(fileList))
 	print("Bias shape:", numpy.shape(biasData))
-	mean = numpy.mean(biasData)
-	median = numpy.median(biasData)
-	stddev = numpy.std(biasData)
+	mean, median, stddev = getStats(biasData, arg.combine)
 	print("Full frame")
 	print("\tmean: {:.1f}\t median: {:.1f}\t std. dev.: {:.2f}".format(mean, median, stddev))
 	midx, midy = ( int(numpy.shape(biasData)[0] / 2), int(numpy.shape(biasData)[1] / 2))
 	pixelRange = 15
 	centralRegion = biasData[midx-pixelRange:midx+pixelRange, midy-pixelRange:midy+pixelRange]
 	print("Size of central sample:", numpy.shape(centralRegion),"or", numpy.shape(centralRegion)[0] * numpy.shape(centralRegion)[1],"pixels.")
-	mean = numpy.mean(centralRegion)
-	median = numpy.median(centralRegion)
-	stddev = numpy.std(centralRegion)
+	mean, median, stddev = getStats(centralRegion, arg.combine)
 	print("\tmean: {:.1f}\t median: {:.1f}\t std. dev.: {:.2f}".format(mean, median, stddev))
 	hdr = astropy.io.fits.Header()
 	hdu = astropy.io.fits.PrimaryHDU(biasData)
 	hdul = astropy.io.fits.HDUList([hdu])
 	hdul.writeto('bias.fits', overwrite=True)
+	if arg.library is not None:
+		calibrationlib.calibrationLibrary(arg.library).add('bias', biasData, header, sources=fileList)
 
 	if arg.preview:
 			ds9Command = ['ds9']
@@ -4,19 +4,34 @@ import matplotlib.pyplot
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
+import combinelib
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
+import statslib
 import astropy
 import subprocess
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a list of FITS files and previews them.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to load.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.25, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.25, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('-i', '--interactive', action="store_true", help="Make each plot interactive (mouse to zoom, etc).")
 	parser.add_argument("--preview",  action="store_true", help="Preview each CCD in 'ds9'.")
 	parser.add_argument("-o", "--outputfilename", type=str, help="Output filename for the flat.")
 	parser.add_argument('-j', '--json', type=str, help="Save to a JSON file (specify filename).")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Takes the matching bias from it if --bias is not given and stores the balance frame in it.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
+	parser.add_argument('-m', '--memory', type=int, default=2048, help="Memory (in MB) to use for the tiled median combine. Default is 2048.")
+	parser.add_argument('-c', '--combine', type=str, default="median", choices=combinelib.combineMethods, help="How to combine the frames. 'sigmaclip' is a sigma-clipped mean, 'minmax' rejects the highest and lowest values. Default is median.")
+	parser.add_argument('--sigma', type=float, default=3.0, help="Rejection threshold (in standard deviations) for the 'sigmaclip' combine. Default is 3.")
+	parser.add_argument('--nlow', type=int, default=1, help="Number of low values to reject for the 'minmax' combine. Default is 1.")
+	parser.add_argument('--nhigh', type=int, default=1, help="Number of high values to reject for the 'minmax' combine. Default is 1.")
 	arg = parser.parse_args()
 	scale = False
 	blocking = False
@@ -25,55 +40,47 @@ if __name__ == "__main__":
 	upperLimit = 62000
 	lowerLimit = 5000
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0] == '#': continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 	
 	
+	bias = None
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
 		bias = hdul[0].data
 		hdul.close()
 
-	matplotlib.pyplot.figure(figsize=(10,10/1.6))
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		if bias is None: bias = library.getMaster('bias', astropy.io.fits.getheader(fileList[0]))
+
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause, figsize=(10,10/1.6))
 	
 	flatFrames = []
-	for index, FITSfile in enumerate(fileList):
+	for index, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList, workers=arg.workers)):
 		frameNo = index+1
 		print("%s: Frame no: %d"%(FITSfile, frameNo))
-		hdul = astropy.io.fits.open(FITSfile)
-		header = hdul[0].header
 		try:
 			expTime = header['EXPTIME']
 		except KeyError:
 			expTime = "unknown"
-		imageData = hdul[0].data
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		
-		flatDict = { "filename": FITSfile, "data": imageData, "reject": False, "expTime": expTime }
-		hdul.close()
-		flatDict['median'] = numpy.median(imageData)
-		flatDict['min'] = numpy.min(imageData)
-		flatDict['max'] = numpy.max(imageData)
+		flatDict = { "filename": FITSfile, "reject": False, "expTime": expTime }
+		flatStats = statslib.histogram(imageData, binWidth=0.5)
+		flatDict['median'] = flatStats.median()
+		flatDict['min'] = flatStats.minimum
+		flatDict['max'] = flatStats.maximum
 		print("Median: %d, Max: %d, Min: %d"%(int(flatDict['median']), int(flatDict['max']), int(flatDict['min'])))
 		# if flatDict['max']>upperLimit: flatDict['reject'] = True
 		if flatDict['min']<lowerLimit: flatDict['reject'] = True
 		if flatDict['reject']: print("\trejected!")
 		flatFrames.append(flatDict)
 		
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
-		matplotlib.pyplot.show(block=False)
-		matplotlib.pyplot.pause(arg.pause)
-		matplotlib.pyplot.clf()
+		preview.submit(imageData, title=FITSfile)
+	preview.close()
 
 
 	# 
@@ -105,20 +112,23 @@ if __name__ == "__main__":
 	validFrames = []
 	for f in flatFrames:
 		if not f['reject']: validFrames.append(f)
-	flatDataArray = [ f['data'] for f in validFrames]
-	if len(flatDataArray)<1: 
+	if len(validFrames)<1: 
 		print("No valid flats in the list.")
 		print("...exit without success")
 		sys.exit()
 
-	flat = numpy.median(flatDataArray, axis = 0)
-	amplifiedImage = generallib.percentiles(flat, 5, 95)
+	flat = combinelib.combineFrames([ f['filename'] for f in validFrames], method=arg.combine, bias=bias, memoryLimit=arg.memory*1024**2, sigma=arg.sigma, nLow=arg.nlow, nHigh=arg.nhigh)
+	amplifiedImage = stretchlib.stretch(flat, 5, 95)
 	matplotlib.pyplot.figure(figsize=(10,10/1.6))
 	matplotlib.pyplot.imshow(amplifiedImage)
 	matplotlib.pyplot.gca().invert_yaxis()
 	matplotlib.pyplot.show(block=blocking)
 
-	hdu = astropy.io.fits.PrimaryHDU(flat)
+	# Record the binning and window so that the balance can be cut to match other frames
+	flatHeader = astropy.io.fits.Header()
+	for keyword in ['CCDSUM', 'CCDXBIN', 'CCDYBIN', 'WINSEC4']:
+		if keyword in header: flatHeader[keyword] = header[keyword]
+	hdu = astropy.io.fits.PrimaryHDU(flat, header=flatHeader)
 	hdul = astropy.io.fits.HDUList([hdu])
 	hdul.writeto('flat.fits', overwrite=True)
 	midx, midy = ( int(numpy.shape(flat)[0] / 2), int(numpy.shape(flat)[1] / 2))
@@ -127,9 +137,11 @@ if __name__ == "__main__":
 	print("Size of central sample:", numpy.shape(centralRegion),"or", numpy.shape(centralRegion)[0] * numpy.shape(centralRegion)[1],"pixels.")
 	mean = numpy.mean(centralRegion)
 	balance = numpy.divide(flat, mean)
-	hdu = astropy.io.fits.PrimaryHDU(balance)
+	hdu = astropy.io.fits.PrimaryHDU(balance, header=flatHeader)
 	hdul = astropy.io.fits.HDUList([hdu])
 	hdul.writeto('balance.fits', overwrite=True)
+	if arg.library is not None:
+		library.add('balance', balance, header, sources=[ f['filename'] for f in validFrames])
 		
 	if arg.preview:
 		ds9Command = ['ds9']
@@ -4,15 +4,18 @@ import matplotlib.pyplot
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
 import astropy
 import json
 import classes
 import shift
+import headerlib
+import selectlib
 
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Shows a list of apertures allows you to select the ones of interest.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to process.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
@@ -27,13 +30,7 @@ if __name__ == "__main__":
 	plotWidth = 8
 	plotHeight = 8/1.7
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
@@ -54,13 +51,8 @@ if __name__ == "__main__":
 	offsets = []
 	frameList = classes.frameDB()
 	for frameNo, FITSfile in enumerate(fileList):
-		hdul = astropy.io.fits.open(FITSfile)
-		FITSHeaders = {}
-		header = hdul[0].header
-		for h in header:
-			FITSHeaders[h] = header[h]
-		imageData = hdul[1].data
-		hdul.close()
+		FITSHeaders = headerlib.readHeader(FITSfile)
+		imageData = astropy.io.fits.getdata(FITSfile, 1)
 		# Subtract the bias
 		if arg.bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
@@ -96,7 +88,7 @@ if __name__ == "__main__":
 		offsets.append(offset)
 		
 		# Draw the image
-		amplifiedImage = numpy.rot90(generallib.percentiles(imageData, 5, 95))
+		amplifiedImage = numpy.rot90(stretchlib.stretch(imageData, 5, 95))
 		matplotlib.pyplot.imshow(amplifiedImage)
 		matplotlib.pyplot.gca().invert_yaxis()
 		matplotlib.pyplot.show(block=False)
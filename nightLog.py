@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import argparse, datetime, json, os, re, time
+import numpy
+import calibrationlib
+import headerlib
+import indexlib
+import loaderlib
+import selectlib
+
+def getTimestamp(header):
+	""" Start time of a frame in seconds (Unix time), from JD or else DATE-OBS (and UTSTART). Returns None if neither is there. """
+	if header.get('JD') is not None: return (float(header['JD']) - 2440587.5) * 86400
+	dateString = header.get('DATE-OBS')
+	if dateString is None: return None
+	dateString = str(dateString)
+	if 'T' not in dateString and header.get('UTSTART') is not None: dateString+= "T" + str(header['UTSTART'])
+	try:
+		when = datetime.datetime.fromisoformat(dateString)
+	except ValueError:
+		return None
+	return when.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def makeFrame(path, header):
+	""" The summary of a frame used for grouping, from a dictionary of its headers. """
+	header = { k: v for k, v in header.items() if v is not None }
+	frame = { 'filename': path, 'run': selectlib.getRunNumber(path) }
+	frame['object'] = str(header.get('OBJECT', "unknown")).strip()
+	frame['filter'] = str(header.get('FILTER', "unknown")).strip()
+	frame['binning'] = calibrationlib.getBinning(header)
+	frame['window'] = calibrationlib.getWindow(header)
+	frame['expTime'] = header.get('EXPTIME')
+	frame['time'] = getTimestamp(header)
+	return frame
+
+def scanFrames(fileList, workers=loaderlib.defaultWorkers):
+	""" Reads the first two headers of each file (primary and first extension), the primary taking precedence. """
+	frames = []
+	for path, headers in headerlib.scanHeaders(fileList, maxHDUs=2, workers=workers):
+		header = {}
+		for h in reversed(headers): header.update(h)
+		frames.append(makeFrame(path, header))
+	return frames
+
+def indexFrames(fileList, indexFilename, workers=loaderlib.defaultWorkers):
+	""" Brings a header index up to date for the files and reads the frames from it. """
+	index = indexlib.headerIndex(indexFilename)
+	index.update(fileList, workers=workers)
+	frames = [ makeFrame(row['path'], dict(row)) for row in index.query(paths=fileList) ]
+	index.close()
+	return frames
+
+def groupRuns(frames, gap=0):
+	""" Splits a time-ordered list of frames into runs of consecutive frames with the same object, filter, binning, window and
+	    exposure time. With gap > 0, a pause of more than gap seconds between frames also starts a new run. """
+	runs = []
+	previous = None
+	for frame in frames:
+		key = (frame['object'], frame['filter'], frame['binning'], frame['window'], frame['expTime'])
+		newRun = previous is None or key!=previous[0]
+		if not newRun and gap>0 and frame['time'] is not None and previous[1] is not None:
+			newRun = frame['time'] - previous[1]>gap
+		if newRun: runs.append([])
+		runs[-1].append(frame)
+		previous = (key, frame['time'])
+	return runs
+
+def summariseRun(run):
+	""" Frame count, timing, cadence and dead time of a run. """
+	first = run[0]
+	summary = { key: first[key] for key in ['object', 'filter', 'binning', 'window', 'expTime'] }
+	summary['frames'] = len(run)
+	summary['firstFile'] = first['filename']
+	summary['lastFile'] = run[-1]['filename']
+	times = numpy.array([ f['time'] for f in run if f['time'] is not None ], dtype=float)
+	summary['start'] = None if len(times)==0 else float(times[0])
+	summary['end'] = None if len(times)==0 else float(times[-1])
+	summary['cadence'] = None
+	summary['deadTime'] = None
+	summary['efficiency'] = None
+	if len(times)>1:
+		cadence = float(numpy.median(numpy.diff(times)))
+		summary['cadence'] = cadence
+		if first['expTime'] is not None:
+			expTime = float(first['expTime'])
+			summary['deadTime'] = cadence - expTime
+			summary['efficiency'] = len(run) * expTime / (times[-1] - times[0] + cadence)
+	return summary
+
+def formatTime(timestamp):
+	if timestamp is None: return "--:--:--"
+	return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%H:%M:%S")
+
+def listFilename(runNumber, summary):
+	name = "run%03d_%s_%s.txt"%(runNumber, summary['object'], summary['filter'])
+	return re.sub(r'[^\w.-]', '_', name)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Groups a night of FITS files into runs and writes a night log with the number of frames, cadence and dead time of each run.')
+	parser.add_argument('inputfiles', type=str, nargs='?', default="folder=.", help=selectlib.inputHelp + " Default is all of the FITS files in the current folder.")
+	parser.add_argument('-i', '--index', type=str, help="Read the headers from (and update) this header index instead of scanning the files.")
+	parser.add_argument('-g', '--gap', type=float, default=0, help="Also start a new run after a pause of more than this many seconds. Default is 0 (off).")
+	parser.add_argument('-o', '--outputpath', type=str, help="Write a list of the files in each run to this folder.")
+	parser.add_argument('-j', '--json', type=str, help="Save the night log to a JSON file (specify filename).")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to read the headers. Default is %d."%loaderlib.defaultWorkers)
+	arg = parser.parse_args()
+
+	startTime = time.time()
+	fileList = selectlib.getFileList(arg.inputfiles)
+	if arg.index is not None: frames = indexFrames(fileList, arg.index, arg.workers)
+	else: frames = scanFrames(fileList, arg.workers)
+	# Put the frames in time order (run number order for frames without a time)
+	frames = sorted(frames, key=lambda f: (f['time'] is None, f['time'] or 0, f['run'] if f['run'] is not None else -1, f['filename']))
+	runs = groupRuns(frames, arg.gap)
+	summaries = [ summariseRun(run) for run in runs ]
+
+	print("%4s %-20s %-8s %-5s %-20s %8s %6s %8s %8s %8s %6s  %s"%("run", "object", "filter", "bin", "window", "exptime", "frames", "start", "end", "cadence", "dead", "first file"))
+	for runNumber, s in enumerate(summaries, 1):
+		cadence = "--" if s['cadence'] is None else "%.2f"%s['cadence']
+		deadTime = "--" if s['deadTime'] is None else "%.2f"%s['deadTime']
+		print("%4d %-20s %-8s %-5s %-20s %8s %6d %8s %8s %8s %6s  %s"%(runNumber, s['object'][:20], s['filter'][:8], s['binning'], s['window'][:20], s['expTime'], s['frames'], formatTime(s['start']), formatTime(s['end']), cadence, deadTime, os.path.basename(s['firstFile'])))
+	print("%d frames in %d runs, read in %.2f seconds."%(len(frames), len(runs), time.time() - startTime))
+
+	if arg.outputpath is not None:
+		os.makedirs(arg.outputpath, exist_ok=True)
+		for runNumber, (run, s) in enumerate(zip(runs, summaries), 1):
+			s['list'] = os.path.join(arg.outputpath, listFilename(runNumber, s))
+			listFile = open(s['list'], 'wt')
+			for frame in run:
+				listFile.write(frame['filename'] + "\n")
+			listFile.close()
+		print("Written %d run lists to %s"%(len(runs), arg.outputpath))
+
+	if arg.json is not None:
+		jsonFile = open(arg.json, 'wt')
+		json.dump(summaries, jsonFile, indent=4)
+		jsonFile.close()
+		print("Written the night log to %s"%arg.json)
@@ -5,10 +5,15 @@ import matplotlib.pyplot
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
 import astropy
 import json
 import classes
+import headerlib
 import shift
+import previewlib
+import calibrationlib
+import badpixellib
 
 
 if __name__ == "__main__":
@@ -17,7 +22,11 @@ if __name__ == "__main__":
 	parser.add_argument('--apertures', type=str, default="apertures.json", help="The JSON file containing the apertures.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--badpixels', type=str, help="Bad pixel mask FITS file (eg the _mask.fits.gz from findHotPixels.py).")
+	parser.add_argument('--badpixelmode', type=str, default="interpolate", choices=["interpolate", "mask"], help="Replace bad pixels by the mean of their neighbours ('interpolate') or leave them out of the aperture sums ('mask'). Default is interpolate.")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Masters matching the frames' configuration are used when --bias or --balance is not given.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('-n', '--nframes', type=int, help="Number of frames to process before stopping. Default is all frames.")
 	arg = parser.parse_args()
 	if arg.nframes is not None:
@@ -28,6 +37,9 @@ if __name__ == "__main__":
 	plotWidth = 8
 	plotHeight = 8/1.7
 
+	bias = None
+	balance = None
+	balanceBinning = (1, 1)
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
@@ -38,12 +50,26 @@ if __name__ == "__main__":
 		print("loading the balance frame", arg.balance)
 		hdul = astropy.io.fits.open(arg.balance)
 		balance = hdul[1].data
+		balanceBinning = calibrationlib.getBinFactors(hdul[1].header)
 		hdul.close()
 
 
 
 	frameList = classes.frameDB()
 	frameList.load()
+
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		libraryHeader = astropy.io.fits.getheader(frameList.allFrames[0]['filesource'])
+		if arg.bias is None: bias = library.getMaster('bias', libraryHeader)
+	balances = None
+	if balance is not None: balances = calibrationlib.balanceCache(balance, balanceBinning)
+	elif arg.library is not None and library.getBalance(libraryHeader) is not None:
+		# Each frame gets the library's balance for its own window and binning
+		balances = calibrationlib.libraryBalances(library)
+	badPixels = None
+	if arg.badpixels is not None: badPixels = badpixellib.badPixelIndex(arg.badpixels)
+
 	apertures = classes.apertureDB()
 	apertures.load()
 	targets = apertures.getTargets()
@@ -54,6 +80,9 @@ if __name__ == "__main__":
 		targetList.append(target)
 	print("Number of reduction apertures:", len(targets))
 	
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause)
+
 	plot = False
 	if plot: 
 		cutFigure = matplotlib.pyplot.figure()
@@ -61,21 +90,22 @@ if __name__ == "__main__":
 		plotGaussian = matplotlib.pyplot.figure()
 	for frame in frameList.allFrames:
 		FITSfile = frame['filesource']
-		hdul = astropy.io.fits.open(FITSfile)
-		FITSHeaders = {}
-		header = hdul[0].header
-		for h in header:
-			FITSHeaders[h] = header[h]
-		imageData = hdul[1].data
-		hdul.close()
+		FITSHeaders = headerlib.readHeader(FITSfile)
+		header = FITSHeaders
+		imageData = astropy.io.fits.getdata(FITSfile, 1)
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
-		if arg.balance is not None: imageData = numpy.divide(imageData, balance)
+		if balances is not None: imageData = numpy.divide(imageData, balances.get(header, numpy.shape(imageData)))
+		# Repair or mask the bad pixels
+		badPixelMask = None
+		if badPixels is not None:
+			frameBadPixels = badPixels.forFrame(header, numpy.shape(imageData))
+			if arg.badpixelmode=="mask": badPixelMask = frameBadPixels.getMask()
+			else: imageData = frameBadPixels.repair(imageData)
 		
 
-		positions = ([t.rootPosition[0] + frame['dx'] for t in targets], [t.rootPosition[1] + frame['dy'] for t in targets])
-		positions = numpy.transpose(positions)
+		positions = numpy.array([ classes.framePosition(frame, t.rootPosition) for t in targets ])
 		
 		from photutils import CircularAperture
 		from photutils import CircularAnnulus
@@ -86,8 +116,8 @@ if __name__ == "__main__":
 		# Cut out a bit of the image near the target
 		t = targets[0]
 		size = 20
-		offsety = -int(frame['dy'])
-		offsetx = -int(frame['dx'])
+		offsety = -int(positions[0][1] - t.rootPosition[1])
+		offsetx = -int(positions[0][0] - t.rootPosition[0])
 
 		left, right = (int(t.rootPosition[0]-size/2), int(t.rootPosition[0]+size/2))
 		top, bottom= (int(t.rootPosition[1]-size/2), int(t.rootPosition[1]+size/2))
@@ -96,7 +126,7 @@ if __name__ == "__main__":
 			from mpl_toolkits.mplot3d import Axes3D 
 			from matplotlib import cm
 			matplotlib.pyplot.figure(cutFigure.number)
-			amplifiedImage = generallib.percentiles(imageCut, 5, 95)
+			amplifiedImage = stretchlib.stretch(imageCut, 5, 95)
 			matplotlib.pyplot.imshow(amplifiedImage)
 			matplotlib.pyplot.gca().invert_yaxis()
 		x = numpy.arange(0, size, 1)
@@ -148,16 +178,14 @@ if __name__ == "__main__":
 			circle1 = matplotlib.pyplot.Circle((xCenter, yCenter), radius, color='r', fill=False)
 			matplotlib.pyplot.gca().add_artist(circle1)
 			
-			matplotlib.pyplot.show(block=True)
+			if not arg.headless: matplotlib.pyplot.show(block=True)
 
 		apertureScaler = radius * 1.6
 		apertures = CircularAperture(positions, r=apertureScaler)
 		skyApertures = CircularAnnulus(positions, r_in=apertureScaler+10, r_out=apertureScaler+18)
 		apers = [apertures, skyApertures]
-		apertures.plot(color='red', lw=1.5, alpha=0.7)
-		skyApertures.plot(color='blue', lw=1.5, alpha=0.7)
 		error = numpy.sqrt(imageData)
-		phot_table = aperture_photometry(imageData, apers, error=error)
+		phot_table = aperture_photometry(imageData, apers, error=error, mask=badPixelMask)
 		for col in phot_table.colnames:
 			phot_table[col].info.format = '%.8g'  # for consistent table outputphot_table['aperture_sum'].info.format = '%.8g'
 		bkg_mean = phot_table['aperture_sum_1']  / skyApertures.area
@@ -175,20 +203,23 @@ if __name__ == "__main__":
 			measurement['extractposition'] = (phot['xcenter'].value, phot['ycenter'].value)
 			targetList[index].addMeasurement(measurement)
 
-		# Draw the image
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
+		# Draw the finder chart for the first frame
 		if frame['frame']==0:
+			finderFigure = matplotlib.pyplot.figure()
+			amplifiedImage = stretchlib.stretch(imageData, 5, 95)
+			matplotlib.pyplot.imshow(amplifiedImage)
+			matplotlib.pyplot.gca().invert_yaxis()
+			apertures.plot(color='red', lw=1.5, alpha=0.7)
+			skyApertures.plot(color='blue', lw=1.5, alpha=0.7)
 			for i, p in enumerate(positions):
 				matplotlib.pyplot.text(p[0]+10, p[1]+10, "%d"%i, color="blue", size="xx-large")
 			matplotlib.pyplot.savefig("finder.png")
-		matplotlib.pyplot.show(block=False)
-		matplotlib.pyplot.pause(arg.pause)
+			matplotlib.pyplot.close(finderFigure)
+		preview.submit(imageData, title=FITSfile, markers=positions)
 
-		matplotlib.pyplot.clf()
 		print("Frame number: {:d}".format(frame['frame']))
 		if frame['frame']>=stopFrame-1: break
+	preview.close()
 
 
 	photometryPlot = matplotlib.pyplot.figure(figsize=(plotWidth, plotHeight))
@@ -249,6 +280,6 @@ if __name__ == "__main__":
 		outputfile.write("\n")
 
 	outputfile.close()
-	input("Press enter to continue")
+	if not arg.headless: input("Press enter to continue")
 	
 	sys.exit()
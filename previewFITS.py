@@ -5,32 +5,35 @@ import datetimelib
 import photometrylib
 import generallib
 import astropy
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
 
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a list of FITS files and previews them.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to load.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save the plot to a file.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.05, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.05, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('-i', '--interactive', action="store_true", help="Make each plot interactive (mouse to zoom, etc).")
 	parser.add_argument('--headers', action="store_true", help="Dump all of the FITS headers to stdout.")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Masters matching the frames' configuration are used when --bias or --balance is not given.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
 	parser.add_argument('-j', '--json', type=str, help="Save to a JSON file (specify filename).")
 	arg = parser.parse_args()
 
 	blocking = False
 	if arg.interactive: blocking = True
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0] == '#': continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
+	bias = None
+	balance = None
+	balanceBinning = (1, 1)
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
@@ -41,34 +44,38 @@ if __name__ == "__main__":
 		print("loading the balance frame", arg.balance)
 		hdul = astropy.io.fits.open(arg.balance)
 		balance = hdul[0].data
+		balanceBinning = calibrationlib.getBinFactors(hdul[0].header)
 		hdul.close()
 
-	
-	for frameNo, FITSfile in enumerate(fileList):
-		hdul = astropy.io.fits.open(FITSfile)
-		#print(hdul.info())
-		header = hdul[0].header
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		libraryHeader = astropy.io.fits.getheader(fileList[0])
+		if arg.bias is None: bias = library.getMaster('bias', libraryHeader)
+	balances = None
+	if balance is not None: balances = calibrationlib.balanceCache(balance, balanceBinning)
+	elif arg.library is not None and library.getBalance(libraryHeader) is not None:
+		# Each frame gets the library's balance for its own window and binning
+		balances = calibrationlib.libraryBalances(library)
+
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause)
+
+	for frameNo, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList, workers=arg.workers)):
 		if arg.headers:
 			for h in header:
 				print(h, header[h])
-		imageData = hdul[0].data
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
-		if arg.balance is not None: imageData = numpy.divide(imageData, balance)
+		if balances is not None: imageData = numpy.divide(imageData, balances.get(header, numpy.shape(imageData)))
 		
 		imageData = numpy.rot90(imageData)
 
 		#print(numpy.shape(imageData))
-		hdul.close()
 
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
-		matplotlib.pyplot.show(block=False)
+		preview.submit(imageData, title=FITSfile)
 		print("Frame number: {:d} run: {:s}".format(frameNo, FITSfile))
-		matplotlib.pyplot.pause(arg.pause)
-		matplotlib.pyplot.clf()
 		#print(imageData)
+	preview.close()
 	
 	sys.exit()
@@ -0,0 +1,100 @@
+import threading, time
+import numpy
+import matplotlib.pyplot
+import stretchlib
+
+def setHeadless():
+	""" Switch matplotlib to a non-interactive backend so that no windows are opened (for batch runs). """
+	matplotlib.pyplot.switch_backend('Agg')
+
+class previewRenderer:
+	""" Shows a live preview of the frames being reduced without holding up the reduction.
+	    The stretch into a uint8 image is done on a background thread and only the most recent frame is kept; frames that arrive while
+	    the previous one is still being prepared are dropped. The stretch limits (percentiles or zscale) are reused for 'refresh' frames.
+	    The window is refreshed at most once every 'interval' seconds, from the main thread on the next submit, update or close.
+	    submit never waits for the stretch, so the preview may lag the reduction by a frame.
+	    With enabled=False every call is a no-op. """
+	def __init__(self, enabled=True, interval=0.01, lo=5, hi=95, figsize=None, method="percentile", refresh=10):
+		self.enabled = enabled
+		self.interval = interval
+		self.lo = lo
+		self.hi = hi
+		self.stretch = stretchlib.displayStretch(lo, hi, method=method, refresh=refresh)
+		self.figsize = figsize
+		self.figure = None
+		self.axes = None
+		self.image = None
+		self.markers = None
+		self.lastDraw = 0
+		self.pending = None
+		self.ready = None
+		self.dropped = 0
+		self.stopping = False
+		self.condition = threading.Condition()
+		if not enabled: return
+		self.thread = threading.Thread(target=self.render, daemon=True)
+		self.thread.start()
+
+	def submit(self, imageData, title="", markers=None):
+		""" Queue a frame for display, replacing any frame that has not been prepared yet. markers is an optional list of (x, y) positions to circle. """
+		if not self.enabled: return
+		with self.condition:
+			if self.pending is not None: self.dropped+= 1
+			self.pending = (imageData, title, markers)
+			self.condition.notify()
+		self.update()
+
+	def render(self):
+		while True:
+			with self.condition:
+				while self.pending is None and not self.stopping:
+					self.condition.wait()
+				if self.pending is None: return
+				imageData, title, markers = self.pending
+				self.pending = None
+			amplifiedImage = self.stretch.apply(imageData)
+			with self.condition:
+				if self.ready is not None: self.dropped+= 1
+				self.ready = (amplifiedImage, title, markers)
+
+	def update(self):
+		""" Draw the latest prepared frame. Must be called from the main thread (submit does this). """
+		if not self.enabled: return
+		now = time.time()
+		if now - self.lastDraw < self.interval: return
+		with self.condition:
+			if self.ready is None: return
+			amplifiedImage, title, markers = self.ready
+			self.ready = None
+		if self.figure is None or not matplotlib.pyplot.fignum_exists(self.figure.number):
+			self.figure = matplotlib.pyplot.figure(figsize=self.figsize)
+			self.axes = self.figure.gca()
+			self.image = None
+			matplotlib.pyplot.show(block=False)
+		if self.image is None or self.image.get_array().shape!=numpy.shape(amplifiedImage):
+			self.axes.clear()
+			self.image = self.axes.imshow(amplifiedImage, origin='lower', vmin=0, vmax=255)
+			self.markers = None
+		else:
+			self.image.set_data(amplifiedImage)
+		if self.markers is not None:
+			self.markers.remove()
+			self.markers = None
+		if markers is not None and len(markers)>0:
+			markers = numpy.asarray(markers)
+			self.markers = self.axes.scatter(markers[:, 0], markers[:, 1], s=200, facecolors='none', edgecolors='red', alpha=0.7)
+		self.axes.set_title(title)
+		self.figure.canvas.draw_idle()
+		self.figure.canvas.flush_events()
+		self.lastDraw = now
+
+	def close(self):
+		""" Show the last frame and stop the rendering thread. The preview window is left open. """
+		if not self.enabled: return
+		with self.condition:
+			self.stopping = True
+			self.condition.notify()
+		self.thread.join()
+		self.lastDraw = 0
+		self.update()
+		if self.dropped>0: print("Preview skipped %d frames to keep up with the reduction."%self.dropped)
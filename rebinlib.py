@@ -0,0 +1,93 @@
+import concurrent.futures, os
+import numpy
+import astropy.io.fits
+import calibrationlib
+import combinelib
+import loaderlib
+
+methods = ['sum', 'mean', 'median']
+defaultBlockMemory = 64 * 1024**2		# Bytes of input rows read at a time
+
+def getBinStarts(length, factor, trim=False):
+	""" First pixel of each bin along an axis. With trim, a partial bin at the end is left out. """
+	end = length - length%factor if trim else length
+	return numpy.arange(0, end, factor), end
+
+def sumBlock(block, rowStarts, columnStarts):
+	""" Sums of the bins in a block of rows, in 64-bit integers for integer data. """
+	if block.dtype.kind in 'ui': sumType = numpy.int64
+	else: sumType = numpy.float64
+	return numpy.add.reduceat(numpy.add.reduceat(block, rowStarts, axis=0, dtype=sumType), columnStarts, axis=1)
+
+def medianBlock(block, factor, rows, columns):
+	""" Medians of the bins in a block of rows. Partial bins at the edges are padded with NaN, which the median ignores. """
+	padded = numpy.full((rows * factor, columns * factor), numpy.nan, dtype=numpy.float32)
+	padded[:block.shape[0], :block.shape[1]] = block
+	bins = padded.reshape(rows, factor, columns, factor).swapaxes(1, 2).reshape(rows, columns, factor * factor)
+	return numpy.nanmedian(bins, axis=2)
+
+def rebinImage(HDU, factor, method="sum", trim=False, blockMemory=defaultBlockMemory):
+	""" Bins an image HDU (opened with combinelib.openFrames) by factor x factor, reading blocks of rows from the memory map.
+	    'sum' adds the pixels in integer arithmetic and clips to the 16-bit range, as the old rebin did; 'mean' and 'median' return float32.
+	    Bins at the right and top edges that are not full are kept (summed or averaged over the pixels they have) unless trim is set. """
+	height, width = HDU.shape
+	columnStarts, columnEnd = getBinStarts(width, factor, trim)
+	rowStarts, rowEnd = getBinStarts(height, factor, trim)
+	itemsize = abs(HDU.header['BITPIX']) // 8
+	binRowsPerBlock = max(1, int(blockMemory // (factor * width * itemsize)))
+	if method=="sum": result = numpy.empty((len(rowStarts), len(columnStarts)), dtype=numpy.uint16)
+	else: result = numpy.empty((len(rowStarts), len(columnStarts)), dtype=numpy.float32)
+	for firstBin in range(0, len(rowStarts), binRowsPerBlock):
+		lastBin = min(firstBin + binRowsPerBlock, len(rowStarts))
+		start = rowStarts[firstBin]
+		end = min(rowEnd, start + (lastBin - firstBin) * factor)
+		block = combinelib.readRows(HDU, start, end)[:, :columnEnd]
+		if method=="median":
+			result[firstBin:lastBin] = medianBlock(block, factor, lastBin - firstBin, len(columnStarts))
+			continue
+		sums = sumBlock(block, rowStarts[firstBin:lastBin] - start, columnStarts)
+		if method=="sum":
+			numpy.clip(sums, 0, 65535, out=sums)
+			result[firstBin:lastBin] = sums
+		else:
+			rowCounts = numpy.diff(numpy.append(rowStarts[firstBin:lastBin], end))
+			columnCounts = numpy.diff(numpy.append(columnStarts, columnEnd))
+			result[firstBin:lastBin] = sums / numpy.outer(rowCounts, columnCounts)
+	return result
+
+def getOutputFilename(FITSfile, factor):
+	""" Adds an _nxn suffix to the filename (before the extension). """
+	return os.path.splitext(FITSfile)[0] + "_%dx%d"%(factor, factor) + os.path.splitext(FITSfile)[1]
+
+def rebinFile(FITSfile, factor, method="sum", outputFilename=None, trim=False, hdu=0, blockMemory=defaultBlockMemory):
+	""" Rebins a FITS file and writes it, with the primary header updated for the new binning. Returns the output filename. """
+	if outputFilename is None: outputFilename = getOutputFilename(FITSfile, factor)
+	hdul = combinelib.openFrames([FITSfile])[0]
+	try:
+		header = hdul[0].header.copy()
+		imageData = rebinImage(combinelib.getImageHDU(hdul, hdu), factor, method, trim, blockMemory)
+	finally:
+		hdul.close()
+	xbin, ybin = calibrationlib.getBinFactors(header)
+	for keyword in ['BZERO', 'BSCALE']: header.remove(keyword, ignore_missing=True)
+	header['CCDSUM'] = "%d %d"%(xbin * factor, ybin * factor)
+	header['CCDXBIN'] = xbin * factor
+	header['CCDYBIN'] = ybin * factor
+	header['REBIN'] = (method, "Method used to rebin by %dx%d"%(factor, factor))
+	astropy.io.fits.PrimaryHDU(imageData, header=header).writeto(outputFilename, overwrite=True)
+	return outputFilename
+
+def rebinFiles(fileList, factor, method="sum", outputFilenames=None, trim=False, hdu=0, workers=loaderlib.defaultWorkers):
+	""" Generator that rebins a list of files in a pool of processes and yields (input, output) filenames in list order. """
+	if outputFilenames is None: outputFilenames = [ getOutputFilename(f, factor) for f in fileList ]
+	if workers<1:
+		for FITSfile, outputFilename in zip(fileList, outputFilenames):
+			yield FITSfile, rebinFile(FITSfile, factor, method, outputFilename, trim, hdu)
+		return
+	n = len(fileList)
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+	try:
+		for FITSfile, outputFilename in zip(fileList, executor.map(rebinFile, fileList, [factor]*n, [method]*n, outputFilenames, [trim]*n, [hdu]*n)):
+			yield FITSfile, outputFilename
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
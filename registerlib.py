@@ -0,0 +1,60 @@
+import numpy
+import calibrationlib
+
+registrationModes = ['stars', 'fft', 'auto', 'affine']
+
+def hanningWindow(shape):
+	""" 2-D Hann window, to stop the frame edges dominating the correlation. """
+	return numpy.outer(numpy.hanning(shape[0]), numpy.hanning(shape[1])).astype(numpy.float32)
+
+def refinePeak(below, peak, above):
+	""" Sub-pixel offset (-0.5 to 0.5) of the vertex of a parabola through three neighbouring samples. """
+	curvature = below - 2*peak + above
+	if curvature>=0: return 0.0
+	return float(numpy.clip(0.5 * (below - above) / curvature, -0.5, 0.5))
+
+class phaseRegistration:
+	""" Measures the shift of frames relative to a reference image by FFT phase correlation, without finding any stars.
+	    The reference spectrum is computed once. The correlation can be done on a central crop (a fraction of each axis)
+	    and/or on frames binned by an integer factor, to make it faster. Shifts are returned as (dx, dy) in the unbinned
+	    pixels of the full frame, in the same sense as shift.vimage: a star at (x, y) in the reference is at (x+dx, y+dy)
+	    in the frame. """
+	def __init__(self, reference, binning=1, crop=1.0):
+		self.binning = binning
+		self.crop = crop
+		self.shape = numpy.shape(reference)
+		prepared = self.prepare(reference)
+		self.window = hanningWindow(numpy.shape(prepared))
+		self.referenceSpectrum = numpy.conj(numpy.fft.rfft2(self.window * prepared))
+
+	def prepare(self, imageData):
+		""" Crops, bins and removes the background (median) of a frame. """
+		height, width = numpy.shape(imageData)
+		border = (1 - self.crop) / 2
+		top, left = int(height * border), int(width * border)
+		region = imageData[top:height-top, left:width-left]
+		if self.binning>1:
+			rows = (numpy.shape(region)[0] // self.binning) * self.binning
+			columns = (numpy.shape(region)[1] // self.binning) * self.binning
+			region = calibrationlib.rebinMean(region[:rows, :columns], self.binning, self.binning)
+		region = numpy.asarray(region, dtype=numpy.float32)
+		region = region - numpy.median(region[::4, ::4])
+		return numpy.nan_to_num(region, copy=False)
+
+	def getShift(self, imageData):
+		""" Returns (dx, dy, peak) where peak (0 to 1) is the height of the correlation peak, a measure of how well the frames match. """
+		if numpy.shape(imageData)!=self.shape:
+			raise ValueError("Frame shape %s does not match the reference %s."%(numpy.shape(imageData), self.shape))
+		prepared = self.prepare(imageData)
+		crossPower = numpy.fft.rfft2(self.window * prepared) * self.referenceSpectrum
+		crossPower/= numpy.abs(crossPower) + 1e-20
+		correlation = numpy.fft.irfft2(crossPower, s=numpy.shape(prepared))
+		height, width = numpy.shape(correlation)
+		iy, ix = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+		peak = correlation[iy, ix]
+		fy = refinePeak(correlation[(iy-1)%height, ix], peak, correlation[(iy+1)%height, ix])
+		fx = refinePeak(correlation[iy, (ix-1)%width], peak, correlation[iy, (ix+1)%width])
+		# Shifts of more than half the frame wrap round to negative
+		if iy>height//2: iy-= height
+		if ix>width//2: ix-= width
+		return float(ix + fx) * self.binning, float(iy + fy) * self.binning, float(peak)
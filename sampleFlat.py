@@ -4,8 +4,10 @@ import matplotlib.pyplot, matplotlib.patches
 import datetimelib
 import photometrylib
 import generallib
+import stretchlib
 import astropy
 import subprocess
+import calibrationlib
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Makes a smaller flat for a windowed run.')
@@ -32,7 +34,7 @@ if __name__ == "__main__":
 	flatData = flatImage
 	
 	matplotlib.pyplot.figure()
-	amplifiedImage = generallib.percentiles(flatData, 10, 98)
+	amplifiedImage = stretchlib.stretch(flatData, 10, 98)
 	matplotlib.pyplot.imshow(amplifiedImage)
 	matplotlib.pyplot.gca().invert_yaxis()
 	
@@ -44,79 +46,42 @@ if __name__ == "__main__":
 		sampleHeaders[h] = header[h]
 		#print(h, header[h])
 	science = {}
-	try: 
-		science = {"CCDXBIN": sampleHeaders['CCDXBIN'],
-				   "CCDYBIN": sampleHeaders['CCDYBIN'],
-				   "WINSEC4": sampleHeaders['WINSEC4']}
-		print(science)
-	except KeyError:
-		print("Could not get binning from FITS headers.")
-		print("Assuming binning of 2")
-		bin = 2
-		window = [3400, 6200, 800, 4000]   
-		#window = [800, 4000, 3400, 6200]   
 	science['data'] = hdul[0].data
-
+	hdul.close()
+	xbin, ybin = calibrationlib.getBinFactors(sampleHeaders)
+	window = calibrationlib.parseWindow(sampleHeaders)
+	print("Science frame binning: %dx%d"%(xbin, ybin))
 	print(numpy.shape(flatData))
 	print(numpy.shape(science['data']))
-	height = window[3] - window[2]
-	width = window[1] - window[0]
-	print("Science frame window: [%d:%d,%d,%d]"%(window[0], window[1], window[2], window[3]))
-	print("Science frame window definition (height, width): (%d, %d)"%(height, width))
-	width, height = width/2, height/2
-	print("Science frame after window and binning: (height, width): (%d, %d)"%(height, width))
-	
-	windowedFlat = flatData[window[2]:window[3],window[0]:window[1]]
-	print(numpy.shape(windowedFlat))
 
-	matplotlib.pyplot.show(block=True)
-	# matplotlib.pyplot.pause(.05)
-
-	sys.exit()
-
-	if 'enabled' in science['WINSEC4']:
-		start = science['WINSEC4'].find('[')
-		end = science['WINSEC4'].find(']')
-		dimensionString = science['WINSEC4'][start+1:end]
-		print(dimensionString)
-		xDimensions = dimensionString.split(',')[0]
-		xStart = int(xDimensions.split(':')[0])
-		xEnd = int(xDimensions.split(':')[1])
-		yDimensions = dimensionString.split(',')[1]
-		yStart = int(yDimensions.split(':')[0])
-		yEnd = int(yDimensions.split(':')[1])
-		print(xStart, xEnd, yStart, yEnd)
-		offset = 47
-		offsety = -1
-		sampledFlat = flatData[yStart+offsety:yEnd+offsety,xStart+offset:xEnd+offset+1]
+	if window is not None:
+		xStart, xEnd, yStart, yEnd = window
+		print("Science frame window: [%d:%d,%d:%d]"%(xStart, xEnd, yStart, yEnd))
 		# Create a Rectangle patch
 		rect = matplotlib.patches.Rectangle((xStart,yStart),(xEnd-xStart),(yEnd-yStart),linewidth=1,edgecolor='r',facecolor='none', ls=":")
 		# Add the patch to the Axes
 		
 		matplotlib.pyplot.gca().add_patch(rect)
 		matplotlib.pyplot.draw()
-	print(numpy.shape(flatData))
-	print(numpy.shape(sampledFlat))
-	print(numpy.shape(science['data']))
-	#sampledFlat = sampledFlat[::2, ::2]
-	from skimage.measure import block_reduce
-	sampledFlat = block_reduce(sampledFlat, block_size=(2, 2), func=numpy.mean)
+	else:
+		print("Science frame is not windowed.")
+	sampledFlat = calibrationlib.extractWindow(flatData, sampleHeaders, calibrationlib.getBinFactors(flatHeaders), shape=numpy.shape(science['data']))
 	print(numpy.shape(sampledFlat))
 	
 	matplotlib.pyplot.figure()
-	amplifiedImage = generallib.percentiles(sampledFlat, 10, 98)
+	amplifiedImage = stretchlib.stretch(sampledFlat, 10, 98)
 	matplotlib.pyplot.imshow(amplifiedImage)
 	matplotlib.pyplot.gca().invert_yaxis()
 	matplotlib.pyplot.show(block=False)
 
 	matplotlib.pyplot.figure()
-	amplifiedImage = generallib.percentiles(science['data'], 10, 98)
+	amplifiedImage = stretchlib.stretch(science['data'], 10, 98)
 	matplotlib.pyplot.imshow(amplifiedImage)
 	matplotlib.pyplot.gca().invert_yaxis()
 	
 	deflatted = numpy.divide(science['data'],sampledFlat)
 	matplotlib.pyplot.figure()
-	amplifiedImage = generallib.percentiles(deflatted, 10, 98)
+	amplifiedImage = stretchlib.stretch(deflatted, 10, 98)
 	matplotlib.pyplot.imshow(amplifiedImage)
 	matplotlib.pyplot.gca().invert_yaxis()
 	
@@ -125,11 +90,14 @@ if __name__ == "__main__":
 
 	hdu = astropy.io.fits.PrimaryHDU(sampledFlat)
 	hdul = astropy.io.fits.HDUList([hdu])
-	hdul.writeto('sampled_balance.fits', overwrite=True)
+	if arg.outputfilename is not None: sampledFilename = arg.outputfilename
+	else: sampledFilename = 'sampled_balance.fits'
+	hdul.writeto(sampledFilename, overwrite=True)
+	print("Written sampled balance to %s"%sampledFilename)
 		
 	if arg.preview:
 		ds9Command = ['ds9']
-		ds9Command.append('sampled_balance.fits')
+		ds9Command.append(sampledFilename)
 		ds9Command.append('-zscale')
 		subprocess.Popen(ds9Command)
 
@@ -150,7 +118,7 @@ if __name__ == "__main__":
 			
 			hdul.close()
 
-			amplifiedImage = generallib.percentiles(imageData, 50, 95)
+			amplifiedImage = stretchlib.stretch(imageData, 50, 95)
 			matplotlib.pyplot.imshow(amplifiedImage)
 			matplotlib.pyplot.gca().invert_yaxis()
 			matplotlib.pyplot.show(block=False)
@@ -158,7 +126,7 @@ if __name__ == "__main__":
 			matplotlib.pyplot.clf()
 		
 		flat = numpy.median(flatFrames, axis = 0)
-		amplifiedImage = generallib.percentiles(flat, 5, 95)
+		amplifiedImage = stretchlib.stretch(flat, 5, 95)
 		matplotlib.pyplot.imshow(amplifiedImage)
 		matplotlib.pyplot.gca().invert_yaxis()
 		matplotlib.pyplot.show(block=False)
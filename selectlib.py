@@ -0,0 +1,80 @@
+import os, re
+import generallib
+import indexlib
+import loaderlib
+
+inputHelp = "A text file listing which files to load, or a frame selection such as \"run=1234-1890 step 2 where EXPTIME>5 and FILTER='R'\" (see selectlib.py)."
+FITSPattern = re.compile('.*.(fits|fits.gz|fits.fz|fit)$')
+
+def getRunNumber(filename):
+	""" The run number of a frame, taken from the last group of digits in its filename (eg r1234567.fit -> 1234567), or None. """
+	numbers = re.findall(r'\d+', os.path.basename(filename).split('.')[0])
+	if len(numbers)==0: return None
+	return int(numbers[-1])
+
+def parseSelection(expression):
+	""" Splits a frame selection into its parts. A selection is
+	        [folder=PATH] [run=RANGES [step N]] [where CONDITION]
+	    where RANGES is a list like 1234-1890,1900 (as generallib.parseIntegerList), step N keeps every N-th run number and CONDITION
+	    is an SQL condition on the indexed header keywords (see indexlib.headerIndex), eg EXPTIME>5 and FILTER='R'. """
+	selection = { 'folder': ".", 'runs': None, 'step': 1, 'where': None }
+	match = re.search(r'\bwhere\b', expression, re.IGNORECASE)
+	if match is not None:
+		selection['where'] = expression[match.end():].strip()
+		expression = expression[:match.start()]
+	tokens = expression.split()
+	position = 0
+	while position<len(tokens):
+		token = tokens[position]
+		if token.lower().startswith('folder='): selection['folder'] = token[len('folder='):]
+		elif token.lower().startswith('run='): selection['runs'] = generallib.parseIntegerList(token[len('run='):])
+		elif token.lower()=='step' and position+1<len(tokens):
+			position+= 1
+			selection['step'] = int(tokens[position])
+		else: raise ValueError("Didn't understand '%s' in the frame selection."%token)
+		position+= 1
+	return selection
+
+def isSelection(inputfiles):
+	""" True if inputfiles is a frame selection rather than the name of a list file. """
+	if os.path.isfile(inputfiles): return False
+	return re.match(r'\s*(folder=|run=|where\b)', inputfiles, re.IGNORECASE) is not None
+
+def selectFrames(expression, indexFilename=None, workers=loaderlib.defaultWorkers):
+	""" Returns the files (in run order) matching a frame selection. The run range is applied to the filenames first, so only the headers
+	    of the frames in range are read, and only if they are not in the folder's header index (headers.db) already. """
+	selection = parseSelection(expression)
+	folder = selection['folder']
+	frames = []
+	for filename in os.listdir(folder):
+		if not FITSPattern.match(filename): continue
+		frames.append((getRunNumber(filename), os.path.join(folder, filename)))
+	frames = sorted(frames, key=lambda f: (f[0] is None, f[0], f[1]))
+	if selection['runs'] is not None:
+		runs = set(sorted(selection['runs'])[::selection['step']])
+		frames = [ f for f in frames if f[0] in runs ]
+	else: frames = frames[::selection['step']]
+	fileList = [ f[1] for f in frames ]
+	if selection['where'] is None or len(fileList)==0: return fileList
+	if indexFilename is None: indexFilename = os.path.join(folder, "headers.db")
+	index = indexlib.headerIndex(indexFilename)
+	index.update(fileList, workers=workers)
+	matching = set(index.select(selection['where'], paths=fileList))
+	index.close()
+	return [ f for f in fileList if f in matching ]
+
+def getFileList(inputfiles):
+	""" The list of files for a script's 'inputfiles' argument: either a text file with one filename per line (blank lines and lines
+	    starting with '#' are skipped) or a frame selection. """
+	if isSelection(inputfiles):
+		fileList = selectFrames(inputfiles)
+		print("Selected %d frames with: %s"%(len(fileList), inputfiles))
+		return fileList
+	fileList = []
+	listFile = open(inputfiles, 'rt')
+	for line in listFile:
+		filename = line.strip()
+		if len(filename)==0 or filename[0] == '#': continue
+		fileList.append(filename)
+	listFile.close()
+	return fileList
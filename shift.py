@@ -4,10 +4,34 @@ import matplotlib.cm as cm
 import numpy as np
 from   scipy.ndimage.filters import gaussian_filter
 from   numpy.linalg import solve
+from   scipy.spatial import cKDTree
 import math
 import matplotlib.pyplot
 
 
+def votes(cat1, cat2, mshift, psize, NHALF):
+    """Returns the (y, x) pixels of the displacement image hit by each pair of
+    stars (one from each catalogue) less than mshift apart in x and y.
+    cat2 is sorted in x so that the stars near each cat1 star in x are found
+    with a binary search, and all of the pairs are then handled as arrays.
+    Empty catalogues (no stars) give no votes.
+    """
+    cat1 = np.asarray(cat1, dtype=float).reshape(-1,2)
+    cat2 = np.asarray(cat2, dtype=float).reshape(-1,2)
+    x1s, y1s = cat1[:,0], cat1[:,1]
+    order = np.argsort(cat2[:,0], kind='stable')
+    x2s, y2s = cat2[order,0], cat2[order,1]
+    lo = np.searchsorted(x2s, x1s-mshift, side='right')
+    hi = np.searchsorted(x2s, x1s+mshift, side='left')
+    counts = np.maximum(hi-lo, 0)
+    i1 = np.repeat(np.arange(len(cat1)), counts)
+    i2 = np.repeat(lo-np.cumsum(counts)+counts, counts) + np.arange(counts.sum())
+    ok = (y2s[i2] > y1s[i1]-mshift) & (y2s[i2] < y1s[i1]+mshift)
+    i1, i2 = i1[ok], i2[ok]
+    ix = NHALF+np.rint((x2s[i2]-x1s[i1])/psize).astype(int)
+    iy = NHALF+np.rint((y2s[i2]-y1s[i1])/psize).astype(int)
+    return iy, ix
+
 def vimage(cat1, cat2, dmax, psize, fwhm):
     """Given two position catalogues of stars, each a numpy array of the form
     [[x0,y0],[x1,y1], ...], assumed to be linearly translated from each this
@@ -29,29 +53,22 @@ def vimage(cat1, cat2, dmax, psize, fwhm):
     NHALF  = int(dmax/psize)
     NSIDE  = 2*NHALF+1
     mshift = (NHALF+0.5)*psize
-    img = np.zeros((NSIDE,NSIDE))
-    x2s, y2s = cat2[:,0], cat2[:,1]
-    for x1, y1 in cat1:
-        ok = (x2s > x1-mshift) & (x2s < x1+mshift) & \
-             (y2s > y1-mshift) & (y2s < y1+mshift)
-        for x2, y2 in cat2[ok]:
-            ix = NHALF+int(round((x2-x1)/psize))
-            iy = NHALF+int(round((y2-y1)/psize))
-            img[iy,ix] += 1
-
-    # smooth image
-    img = gaussian_filter(img,fwhm/psize/2.3548,mode='constant')
-
-    # identify maximum pixel
-    ind = np.arange(NSIDE)
-    ix, iy = np.meshgrid(ind, ind)
-    peak = img == img.max()
-    #if len(ix[peak]) > 1:
-    #    raise Exception("Found more than one maximum pixel")
+    iy, ix = votes(cat1, cat2, mshift, psize, NHALF)
+    img = np.bincount(iy*NSIDE+ix, minlength=NSIDE*NSIDE).reshape(NSIDE,NSIDE).astype(float)
+
+    # smooth image. The smoothed image is zero more than the filter radius
+    # from any vote, so only the box around the votes needs to be filtered
+    sigma = fwhm/psize/2.3548
+    if len(ix) > 0:
+        radius = int(4.0*sigma+0.5)
+        y0, y1 = max(0, iy.min()-radius), min(NSIDE, iy.max()+radius+1)
+        x0, x1 = max(0, ix.min()-radius), min(NSIDE, ix.max()+radius+1)
+        img[y0:y1,x0:x1] = gaussian_filter(img[y0:y1,x0:x1],sigma,mode='constant')
+
+    # identify maximum pixel (the first one, in row order, if there is a tie)
+    iyp, ixp = np.unravel_index(np.argmax(img), img.shape)
 
     # now have first approximation to the shift
-    ixp = ix[peak][0]
-    iyp = iy[peak][0]
     xp = psize*(ixp-NHALF)
     yp = psize*(iyp-NHALF)
     if ixp == 0 or ixp == NSIDE-1 or iyp == 0 or iyp == NSIDE-1:
@@ -91,22 +108,232 @@ def match(cat1, cat2, xs, ys, mmax):
       nmatch : number of unique matches found
       inds   : indices of matching stars in cat1 for each cat2 star; -1
                if not matched. Hence len(inds[inds > -1]) == nmatch.
+    A cat2 star is matched if exactly one cat1 star lies within mmax of it
+    in both X and Y. The two nearest cat1 stars (in that sense) are found
+    with a k-d tree.
     """
 
-    nmatch = 0
-    x1s, y1s  = cat1[:,0], cat1[:,1]
-    ind1 = np.arange(len(cat1))
     ind2 = np.empty(len(cat2),dtype=int)
     ind2.fill(-1)
-    for i2, p2 in enumerate(cat2):
-        x2, y2 = p2
-        ok = (x1s > x2-xs-mmax) & (x1s < x2-xs+mmax) & \
-             (y1s > y2-ys-mmax) & (y1s < y2-ys+mmax)
-        if len(x1s[ok]) == 1:
-            nmatch += 1
-            ind2[i2] = ind1[ok][0]
-
-    return (nmatch, ind2)
+    if len(cat1) == 0 or len(cat2) == 0:
+        return (0, ind2)
+    shifted = np.asarray(cat2, dtype=float) - (xs, ys)
+    dist, inds = cKDTree(cat1).query(shifted, k=2, p=np.inf)
+    dist, inds = dist.reshape(len(cat2),-1), inds.reshape(len(cat2),-1)
+    single = dist[:,0] < mmax
+    if dist.shape[1] > 1:
+        single &= ~(dist[:,1] < mmax)
+    ind2[single] = inds[single,0]
+    return (int(single.sum()), ind2)
+
+def matchCatalogues(cat1, cat2, xs, ys, mmax):
+    """
+    Pairs each cat2 star with its nearest cat1 star after shifting cat2 by
+    -(xs,ys), using a k-d tree. Only pairs closer than mmax (Euclidean) are
+    kept, and each cat1 star is used at most once: if several cat2 stars
+    have the same nearest cat1 star, the closest one gets it.
+    Arguments::
+      cat1 : first catalogues of (x,y) pairs
+      cat2 : second catalogues of (x,y) pairs
+      xs   : Shift in X of cat2 relative to cat1
+      ys   : Shift in Y of cat2 relative to cat1
+      mmax : maximum distance for a match
+    Returns::
+      inds      : index of the matching cat1 star for each cat2 star; -1
+                  if not matched.
+      dists     : distance of each match (inf if not matched)
+      ambiguous : True for matches where another cat1 star is also within
+                  mmax, or another cat2 star had the same nearest cat1 star
+    """
+
+    inds = np.full(len(cat2), -1, dtype=int)
+    dists = np.full(len(cat2), np.inf)
+    ambiguous = np.zeros(len(cat2), dtype=bool)
+    if len(cat1) == 0 or len(cat2) == 0:
+        return (inds, dists, ambiguous)
+    shifted = np.asarray(cat2, dtype=float) - (xs, ys)
+    dist, near = cKDTree(cat1).query(shifted, k=2, distance_upper_bound=mmax)
+    dist, near = dist.reshape(len(cat2),-1), near.reshape(len(cat2),-1)
+    found = dist[:,0] < mmax
+    if dist.shape[1] > 1:
+        ambiguous = found & (dist[:,1] < mmax)
+
+    # keep the closest cat2 star for each cat1 star
+    candidates = np.flatnonzero(found)
+    order = candidates[np.lexsort((dist[candidates,0], near[candidates,0]))]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = near[order[1:],0] != near[order[:-1],0]
+    claimed = np.bincount(near[order,0], minlength=len(cat1)) > 1
+    winners = order[first]
+    inds[winners] = near[winners,0]
+    dists[winners] = dist[winners,0]
+    ambiguous[winners] |= claimed[near[winners,0]]
+    ambiguous[inds < 0] = False
+    return (inds, dists, ambiguous)
+
+def triangles(cat, nneigh=5):
+    """
+    Forms the triangles between each star and pairs of its nneigh nearest
+    neighbours, and works out their shape invariants.
+    Arguments::
+      cat    : catalogue of (x,y) pairs
+      nneigh : number of neighbours of each star used to make triangles
+    Returns::
+      verts  : (M,3) indices of the vertices of each triangle, ordered by
+               the length of the opposite side, longest first
+      invs   : (M,2) ratios of the middle and shortest sides to the longest,
+               which do not change with translation, rotation or scale
+      orient : (M,) +1 or -1, the handedness of the ordered vertices
+    """
+
+    cat = np.asarray(cat, dtype=float)
+    nneigh = min(nneigh, len(cat)-1)
+    if nneigh < 2:
+        return (np.empty((0,3),dtype=int), np.empty((0,2)), np.empty(0,dtype=int))
+    near = cKDTree(cat).query(cat, k=nneigh+1)[1][:,1:]
+    pairs = np.array(list(itertools.combinations(range(nneigh), 2)))
+    verts = np.column_stack((np.repeat(np.arange(len(cat)), len(pairs)),
+                             near[:,pairs].reshape(-1,2)))
+    verts = np.unique(np.sort(verts, axis=1), axis=0)
+
+    p = cat[verts]
+    sides = np.column_stack((np.hypot(*(p[:,1]-p[:,2]).T),
+                             np.hypot(*(p[:,0]-p[:,2]).T),
+                             np.hypot(*(p[:,0]-p[:,1]).T)))
+    order = np.argsort(-sides, axis=1, kind='stable')
+    verts = np.take_along_axis(verts, order, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    ok = sides[:,2] > 0
+    verts, sides = verts[ok], sides[ok]
+    invs = sides[:,1:]/sides[:,:1]
+    p = cat[verts]
+    e1, e2 = p[:,1]-p[:,0], p[:,2]-p[:,0]
+    orient = np.where(e1[:,0]*e2[:,1]-e1[:,1]*e2[:,0] >= 0, 1, -1)
+    return (verts, invs, orient)
+
+def asterismIndex(cat, nneigh=5, qstep=0.01):
+    """
+    Builds a hash index of the triangles of a reference catalogue, keyed on
+    their invariants quantised in steps of qstep and their handedness, so
+    that similar triangles in another catalogue are found with a few
+    dictionary lookups each.
+    Returns::
+      index : dictionary of key -> list of triangle numbers
+      verts : vertices of the triangles, as returned by triangles
+    """
+
+    verts, invs, orient = triangles(cat, nneigh)
+    keys = np.floor(invs/qstep).astype(int)
+    index = {}
+    for n, (k1, k2, o) in enumerate(zip(keys[:,0], keys[:,1], orient)):
+        index.setdefault((k1, k2, o), []).append(n)
+    return (index, verts)
+
+def solveAffine(cat1, cat2):
+    """
+    Least-squares affine transform taking the (x,y) pairs of cat1 onto the
+    matching pairs of cat2, i.e. cat2 = cat1 @ A.T + t.
+    Returns::
+      A : 2x2 matrix (rotation, scale and shear)
+      t : translation (x,y)
+    """
+
+    X = np.column_stack((cat1, np.ones(len(cat1))))
+    coeffs = np.linalg.lstsq(X, cat2, rcond=None)[0]
+    return (coeffs[:2].T, coeffs[2])
+
+def rotationScale(A):
+    """
+    Rotation (degrees, anticlockwise) and scale of the similarity transform
+    closest to the affine matrix A.
+    """
+
+    rotation = math.degrees(math.atan2(A[1,0]-A[0,1], A[0,0]+A[1,1]))
+    scale = math.sqrt(abs(np.linalg.det(A)))
+    return (rotation, scale)
+
+def vaffine(cat1, cat2, nneigh=5, qstep=0.01, mmax=3., ntrials=100, nmin=4,
+            index=None):
+    """
+    Works out the affine transform that takes cat1 onto cat2 by matching
+    asterisms, so that unlike vimage it copes with rotation and changes of
+    scale (field rotation, flexure) as well as translations of any size.
+    Method: triangles of neighbouring stars in cat2 are looked up in a hash
+    index of the triangles in cat1 by their shape. Each pair of similar
+    triangles votes for the three star pairs it implies. The best-voted
+    triangle pairs each give an exact affine transform, which is scored by
+    how many cat1 stars it puts within mmax of a cat2 star. The best one is
+    refined by least squares on those matches.
+    Arguments::
+      cat1    : first (reference) position catalogue
+      cat2    : second position catalogue
+      nneigh  : number of neighbours of each star used to make triangles
+      qstep   : tolerance on the triangle side ratios
+      mmax    : maximum distance for a star to count as matched
+      ntrials : number of triangle pairs to try
+      nmin    : fewest matched stars for a solution to be accepted
+      index   : asterismIndex of cat1, to save rebuilding it for each frame
+    Returns::
+      A      : 2x2 matrix, cat2 = cat1 @ A.T + t (None if no solution)
+      t      : translation (x,y) (None if no solution)
+      inds   : index of the matching cat2 star for each cat1 star; -1 if not
+               matched
+    """
+
+    cat1 = np.asarray(cat1, dtype=float).reshape(-1,2)
+    cat2 = np.asarray(cat2, dtype=float).reshape(-1,2)
+    inds = np.full(len(cat1), -1, dtype=int)
+    if len(cat1) < 3 or len(cat2) < 3:
+        return (None, None, inds)
+    if index is None:
+        index = asterismIndex(cat1, nneigh, qstep)
+    table, verts1 = index
+    verts2, invs2, orient2 = triangles(cat2, nneigh)
+
+    # look up each triangle in its own and the neighbouring cells
+    keys = np.floor(invs2/qstep).astype(int)
+    tri1, tri2 = [], []
+    for n, (k1, k2, o) in enumerate(zip(keys[:,0], keys[:,1], orient2)):
+        for d1, d2 in itertools.product((-1,0,1), repeat=2):
+            found = table.get((k1+d1, k2+d2, o))
+            if found:
+                tri1.extend(found)
+                tri2.extend([n]*len(found))
+    if len(tri1) == 0:
+        return (None, None, inds)
+    tri1, tri2 = np.array(tri1), np.array(tri2)
+
+    # votes for star pairs, and the total vote of each triangle pair
+    pairs = verts1[tri1]*len(cat2) + verts2[tri2]
+    unique, inverse, counts = np.unique(pairs, return_inverse=True,
+                                        return_counts=True)
+    score = counts[inverse.reshape(pairs.shape)].sum(axis=1)
+    trials = np.argsort(-score, kind='stable')[:ntrials]
+
+    tree = cKDTree(cat2)
+    best, bestn = None, 0
+    for n in trials:
+        p1, p2 = cat1[verts1[tri1[n]]], cat2[verts2[tri2[n]]]
+        if abs(np.linalg.det(np.column_stack((p1, np.ones(3))))) < 1e-6:
+            continue
+        A, t = solveAffine(p1, p2)
+        dist = tree.query(cat1 @ A.T + t, distance_upper_bound=mmax)[0]
+        nmatch = int((dist < mmax).sum())
+        if nmatch > bestn:
+            best, bestn = (A, t), nmatch
+    if bestn < nmin:
+        return (None, None, inds)
+
+    # refine on all of the matched stars
+    A, t = best
+    for i in range(3):
+        dist, near = tree.query(cat1 @ A.T + t, distance_upper_bound=mmax)
+        ok = dist < mmax
+        if ok.sum() < 3:
+            break
+        A, t = solveAffine(cat1[ok], cat2[near[ok]])
+    inds[ok] = near[ok]
+    return (A, t, inds)
 
 if __name__ == '__main__':
 
@@ -2,10 +2,17 @@
 import argparse, sys, numpy
 import matplotlib.pyplot
 import generallib
+import stretchlib
 import astropy.io.fits
 import classes
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
+import badpixellib
 import shift
-from astropy.stats import sigma_clipped_stats
+import statslib
+import registerlib
 from photutils import datasets
 from photutils import DAOStarFinder
 import scipy
@@ -18,30 +25,34 @@ def onclick(event):
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Loads a list of FITS files and stacks them to a median/mean image.')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to load.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
 	parser.add_argument('-S', '--skip', type=int, default=5, help="Number of frames to skip before starting the stacking.")
 	parser.add_argument('-n', '--nframes', type=int, default=5, help="Number of frames to mean and median. Default value: 5.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 	parser.add_argument('--shift', action="store_true", help="Find bright points and shift images to match before stacking.")
 	parser.add_argument('--preview', action="store_true", help="Preview the output in DS9.")
+	parser.add_argument('--badpixels', type=str, help="Bad pixel mask FITS file (eg the _mask.fits.gz from findHotPixels.py). Bad pixels are replaced by the mean of their neighbours.")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Masters matching the frames' configuration are used when --bias or --balance is not given.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
 	parser.add_argument('--border', type=int, default=0, help="Trim away this number of pixels from the edges.")
+	parser.add_argument('--register', type=str, default="stars", choices=registerlib.registrationModes, help="How to measure the frame shifts (with --shift). 'stars' matches the stars found in each frame, 'fft' uses phase correlation of the images and 'auto' uses phase correlation only for frames with fewer than --minstars stars and 'affine' matches triangles of stars, allowing for rotation and changes of scale. Default is stars.")
+	parser.add_argument('--minstars', type=int, default=5, help="Fewest stars needed to register a frame on its stars in 'auto' mode. Default is 5.")
+	parser.add_argument('--fftbin', type=int, default=1, help="Bin the frames by this factor for the phase correlation. Default is 1.")
+	parser.add_argument('--fftcrop', type=float, default=1.0, help="Fraction of each axis (centred) used for the phase correlation. Default is 1.0.")
 	
 	arg = parser.parse_args()
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0] == '#': continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
 	print(fileList)
 
+	bias = None
+	balance = None
+	balanceBinning = (1, 1)
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
@@ -52,31 +63,44 @@ if __name__ == "__main__":
 		print("loading the balance frame", arg.balance)
 		hdul = astropy.io.fits.open(arg.balance)
 		balance = hdul[0].data
+		balanceBinning = calibrationlib.getBinFactors(hdul[0].header)
 		hdul.close()
 
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		libraryHeader = astropy.io.fits.getheader(fileList[0])
+		if arg.bias is None: bias = library.getMaster('bias', libraryHeader)
+	balances = None
+	if balance is not None: balances = calibrationlib.balanceCache(balance, balanceBinning)
+	elif arg.library is not None and library.getBalance(libraryHeader) is not None:
+		# Each frame gets the library's balance for its own window and binning
+		balances = calibrationlib.libraryBalances(library)
+	badPixels = None
+	if arg.badpixels is not None: badPixels = badpixellib.badPixelIndex(arg.badpixels)
+
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not arg.headless, interval=arg.pause)
+
 	medianFrameStack = []	
 	startFrame = arg.skip+1
 	endFrame = arg.skip + 1 + arg.nframes
 	print("Building stack from frame %d to %d."%(startFrame, endFrame))
 	offsets = []
-	for frame in range(startFrame, endFrame): 
-		index = frame - 1
-		FITSfile = fileList[index]
+	stackList = fileList[startFrame-1:endFrame-1]
+	for frame, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(stackList, workers=arg.workers), start=startFrame): 
 		print("Frame number: {:d}, Filename: {}".format(frame, FITSfile))
 	
-		hdul = astropy.io.fits.open(FITSfile)
 		# Put all of the headers into a dictionary object
 		FITSHeaders = {}
-		header = hdul[0].header
 		for h in header:
 			FITSHeaders[h] = header[h]
-		imageData = hdul[0].data
 
-		hdul.close()
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
-		if arg.balance is not None: imageData = numpy.divide(imageData, balance)
+		if balances is not None: imageData = numpy.divide(imageData, balances.get(header, numpy.shape(imageData)))
+		# Repair the bad pixels
+		if badPixels is not None: imageData = badPixels.forFrame(header, numpy.shape(imageData)).repair(imageData)
 
 		# Trim away the vignetted regions	
 		if arg.border>0:
@@ -86,13 +110,18 @@ if __name__ == "__main__":
 			imageData = numpy.rot90(imageData)
 		
 		if arg.shift:
-			if frame == startFrame:
+			if frame == startFrame and arg.register in ["fft", "auto"]:
+				registration = registerlib.phaseRegistration(imageData, binning=arg.fftbin, crop=arg.fftcrop)
+			if frame == startFrame and arg.register=="fft": pass
+			elif frame == startFrame:
 				# Find the point sources
-				mean, median, std = sigma_clipped_stats(imageData, sigma=3.0)
+				mean, median, std = statslib.sigmaClippedStats(imageData, sigma=3.0)
 				daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)  
 				sources = daofind(imageData - median)  
-				for col in sources.colnames:
-					sources[col].info.format = '%.8g'  # for consistent table output
+				if sources is None: sources = []
+				else:
+					for col in sources.colnames:
+						sources[col].info.format = '%.8g'  # for consistent table output
 				apertureList = classes.apertureDB()
 				cat1 = []
 				for s in sources:
@@ -102,31 +131,59 @@ if __name__ == "__main__":
 				apertureList.enableTrackers(n=10)
 				cat1 = numpy.array(apertureList.makeCatalog())
 				#print(cat1)
+				if arg.register=="affine": asterisms = shift.asterismIndex(cat1)
 			else:	
-				# Find the point sources
-				mean, median, std = sigma_clipped_stats(imageData, sigma=3.0)
-				daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)  
-				sources = daofind(imageData - median)  
-				for col in sources.colnames:
-					sources[col].info.format = '%.8g'  # for consistent table output
-				apertureList = classes.apertureDB()
 				cat2 = []
-				for s in sources:
-					target = classes.apertureClass((s['xcentroid'], s['ycentroid']), s['peak'])
-					apertureList.add(target)
-				apertureList.sort()
-				apertureList.enableTrackers(n=10)
-				cat2 = numpy.array(apertureList.makeCatalog())
-				#print(cat2)
+				if arg.register!="fft":
+					# Find the point sources
+					mean, median, std = statslib.sigmaClippedStats(imageData, sigma=3.0)
+					daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)  
+					sources = daofind(imageData - median)  
+					if sources is None: sources = []
+					else:
+						for col in sources.colnames:
+							sources[col].info.format = '%.8g'  # for consistent table output
+					apertureList = classes.apertureDB()
+					for s in sources:
+						target = classes.apertureClass((s['xcentroid'], s['ycentroid']), s['peak'])
+						apertureList.add(target)
+					apertureList.sort()
+					apertureList.enableTrackers(n=10)
+					cat2 = numpy.array(apertureList.makeCatalog())
+					#print(cat2)
 				dmax = 50
 				fwhm = 4
 				psize = 0.5
 				mmax = 3
-				img, xp,yp,xr,yr = shift.vimage(cat1, cat2, dmax, psize, fwhm)
-				offset = { 'frame': frame, 'filesource': FITSfile, 'dx': xr, 'dy': yr}
+				A = None
+				if arg.register=="affine":
+					A, t, inds = shift.vaffine(cat1, cat2, mmax=mmax, index=asterisms)
+					if A is None: print("Could not match the asterisms in %s, assuming a translation only."%FITSfile)
+				if A is not None:
+					# The shift is measured at the centre of the frame, which the rotation and scale are about
+					centre = numpy.array(numpy.shape(imageData)[::-1]) / 2
+					xr, yr = A @ centre + t - centre
+					rotation, scale = shift.rotationScale(A)
+				elif arg.register in ["stars", "affine"] or (arg.register=="auto" and len(cat1)>=arg.minstars and len(cat2)>=arg.minstars):
+					if len(cat1)==0 or len(cat2)==0:
+						print("No stars to match in %s, leaving it out of the stack."%FITSfile)
+						preview.submit(imageData, title=FITSfile)
+						continue
+					img, xp,yp,xr,yr = shift.vimage(cat1, cat2, dmax, psize, fwhm)
+				else:
+					xr, yr, peak = registration.getShift(imageData)
+				offset = { 'frame': frame, 'filesource': FITSfile, 'dx': float(xr), 'dy': float(yr)}
+				if A is not None:
+					offset['rotation'] = rotation
+					offset['scale'] = scale
+					offset['centre'] = [ float(c) for c in centre ]
 				print(offset)
 				offsets.append(offset)
-				shiftedFrame = scipy.ndimage.shift(imageData, (xr, yr))
+				if A is not None:
+					# Resample the frame onto the reference: reference (x, y) is at A(x, y) + t in this frame, in (row, column) order
+					shiftedFrame = scipy.ndimage.affine_transform(imageData, A[::-1, ::-1], offset=t[::-1], order=1)
+				else:
+					shiftedFrame = scipy.ndimage.shift(imageData, (xr, yr))
 		else:	
 			shiftFrame = imageData
 
@@ -137,17 +194,13 @@ if __name__ == "__main__":
 		else: average = numpy.add(average, shiftedFrame)
 		medianFrameStack.append(shiftedFrame)
 		
-		amplifiedImage = generallib.percentiles(imageData, 5, 95)
-		matplotlib.pyplot.imshow(amplifiedImage)
-		matplotlib.pyplot.gca().invert_yaxis()
-		matplotlib.pyplot.show(block=False)
-		matplotlib.pyplot.pause(arg.pause)
-		matplotlib.pyplot.clf()
+		preview.submit(imageData, title=FITSfile)
+	preview.close()
 	
 	
-	average = numpy.divide(average, arg.nframes)
+	average = numpy.divide(average, len(medianFrameStack))
 	medianFrame = numpy.median(medianFrameStack, axis=0)
-	amplifiedImage = generallib.percentiles(medianFrame, 5, 95)
+	amplifiedImage = stretchlib.stretch(medianFrame, 5, 95)
 	
 	fig = matplotlib.pyplot.figure(figsize=(12/1.6, 12))
 	matplotlib.pyplot.imshow(amplifiedImage)
@@ -157,7 +210,7 @@ if __name__ == "__main__":
 		print("Saving image to {}".format(arg.save))
 		matplotlib.pyplot.savefig(arg.save)
 
-	matplotlib.pyplot.show(block=True)
+	if not arg.headless: matplotlib.pyplot.show(block=True)
 
 	hdr = astropy.io.fits.Header()
 	hdu = astropy.io.fits.PrimaryHDU(medianFrame)
@@ -0,0 +1,107 @@
+import numpy
+
+def weightedPercentile(values, counts, percent, cumulative=None):
+	""" Percentile of data given as sorted values and the number of times each occurs, interpolated in the same way as numpy.percentile. """
+	if cumulative is None: cumulative = numpy.cumsum(counts)
+	n = cumulative[-1]
+	if n==0: return numpy.nan
+	rank = numpy.asarray(percent, dtype=numpy.float64) / 100 * (n - 1)
+	lower = numpy.floor(rank)
+	lowerValue = values[numpy.searchsorted(cumulative, lower, side='right')]
+	upperValue = values[numpy.searchsorted(cumulative, numpy.minimum(lower + 1, n - 1), side='right')]
+	return lowerValue + (rank - lower) * (upperValue - lowerValue)
+
+class histogram:
+	""" Robust statistics of a frame from a single histogram pass. The pixels are counted with numpy.bincount in blocks of chunkSize,
+	    so there is no sorted or float64 copy of the frame, and the median, percentiles, MAD, sigma-clipped statistics and saturation
+	    count all come from the 65536 bins of a 16-bit frame. Integer data are exact. Floating point data (eg bias subtracted) are rounded
+	    to the nearest multiple of binWidth, so use binWidth=0.5 for frames that are the median of an even number of integer frames.
+	    Values more than maxBins bins above the minimum are counted in the top bin, and NaNs are ignored. """
+	chunkSize = 1<<20
+
+	def __init__(self, data, binWidth=1, saturation=65535, maxBins=1<<20):
+		data = numpy.asarray(data).ravel()
+		self.binWidth = binWidth
+		self.saturationLevel = saturation
+		isInteger = data.dtype.kind in 'ui'
+		if not isInteger: data = data[numpy.isfinite(data)]
+		if len(data)==0: raise ValueError("No valid pixels to make a histogram from.")
+		if isInteger and binWidth==1: self.offset = int(numpy.min(data))
+		else: self.offset = numpy.floor(numpy.min(data) / binWidth) * binWidth
+		top = int(maxBins) - 1
+		self.counts = numpy.zeros(1, dtype=numpy.int64)
+		for start in range(0, len(data), histogram.chunkSize):
+			chunk = data[start:start + histogram.chunkSize]
+			if isInteger and binWidth==1: indices = chunk.astype(numpy.intp) - self.offset
+			else: indices = numpy.rint((chunk - self.offset) / binWidth).astype(numpy.intp)
+			numpy.minimum(indices, top, out=indices)
+			chunkCounts = numpy.bincount(indices)
+			if len(chunkCounts)>len(self.counts):
+				chunkCounts[:len(self.counts)]+= self.counts
+				self.counts = chunkCounts
+			else: self.counts[:len(chunkCounts)]+= chunkCounts
+		self.values = self.offset + numpy.arange(len(self.counts)) * binWidth
+		self.cumulative = numpy.cumsum(self.counts)
+		self.n = int(self.cumulative[-1])
+		occupied = numpy.flatnonzero(self.counts)
+		self.minimum = self.values[occupied[0]]
+		self.maximum = self.values[occupied[-1]]
+
+	def percentile(self, percent):
+		return weightedPercentile(self.values, self.counts, percent, self.cumulative)
+
+	def median(self):
+		return self.percentile(50)
+
+	def mean(self):
+		return numpy.dot(self.counts, self.values) / self.n
+
+	def std(self):
+		return numpy.sqrt(numpy.dot(self.counts, (self.values - self.mean())**2) / self.n)
+
+	def mad(self):
+		""" Median absolute deviation from the median. """
+		deviations = numpy.abs(self.values - self.median())
+		order = numpy.argsort(deviations, kind='stable')
+		return weightedPercentile(deviations[order], self.counts[order], 50)
+
+	def saturated(self, level=None):
+		""" Number of pixels at or above the saturation level. """
+		if level is None: level = self.saturationLevel
+		return int(numpy.sum(self.counts[self.values>=level]))
+
+	def clippedStats(self, sigma=3.0, maxiters=5):
+		""" Mean, median and standard deviation after iteratively rejecting pixels more than sigma standard deviations from the median,
+		    as astropy.stats.sigma_clipped_stats does. """
+		counts = self.counts
+		for iteration in range(maxiters):
+			cumulative = numpy.cumsum(counts)
+			n = cumulative[-1]
+			median = weightedPercentile(self.values, counts, 50, cumulative)
+			mean = numpy.dot(counts, self.values) / n
+			std = numpy.sqrt(numpy.dot(counts, (self.values - mean)**2) / n)
+			keep = (self.values>=median - sigma*std) & (self.values<=median + sigma*std)
+			clipped = numpy.where(keep, counts, 0)
+			if numpy.sum(clipped)==n: break
+			counts = clipped
+		cumulative = numpy.cumsum(counts)
+		n = cumulative[-1]
+		mean = numpy.dot(counts, self.values) / n
+		std = numpy.sqrt(numpy.dot(counts, (self.values - mean)**2) / n)
+		return mean, weightedPercentile(self.values, counts, 50, cumulative), std
+
+def sigmaClippedStats(data, sigma=3.0, maxiters=5, binWidth=None):
+	""" Drop-in for astropy.stats.sigma_clipped_stats (returns mean, median, std). Integer frames use a histogram, which is exact.
+	    Floating point frames (eg bias subtracted and flat fielded) are clipped exactly, unless a binWidth is given to use a histogram
+	    rounded to that width instead. """
+	data = numpy.asarray(data)
+	if binWidth is not None or data.dtype.kind in 'ui':
+		return histogram(data, binWidth=binWidth or 1).clippedStats(sigma, maxiters)
+	values = data[numpy.isfinite(data)]
+	for iteration in range(maxiters):
+		median = numpy.median(values)
+		std = numpy.std(values)
+		clipped = values[(values>=median - sigma*std) & (values<=median + sigma*std)]
+		if len(clipped)==len(values): break
+		values = clipped
+	return numpy.mean(values), numpy.median(values), numpy.std(values)
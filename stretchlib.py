@@ -0,0 +1,72 @@
+import math
+import numpy
+import statslib
+
+defaultSamples = 250000
+
+def subsample(data, maxPixels=defaultSamples):
+	""" A view of the image on a regular grid with at most about maxPixels pixels. """
+	step = max(1, int(math.ceil(math.sqrt(numpy.size(data) / maxPixels))))
+	return data[::step, ::step]
+
+def percentileLimits(data, lo, hi, maxPixels=defaultSamples):
+	""" The lo and hi percentiles of the image, measured on a subsampled grid. Integer images use a histogram instead of a sort. """
+	sample = subsample(data, maxPixels)
+	if sample.dtype.kind in 'ui': low, high = statslib.histogram(sample).percentile([lo, hi])
+	else: low, high = numpy.percentile(sample[numpy.isfinite(sample)], [lo, hi])
+	return float(low), float(high)
+
+def zscaleLimits(data, contrast=0.25, maxPixels=defaultSamples):
+	""" IRAF-style zscale limits, measured on a subsampled grid. """
+	from astropy.visualization import ZScaleInterval
+	sample = subsample(data, maxPixels)
+	low, high = ZScaleInterval(contrast=contrast).get_limits(sample[numpy.isfinite(sample)])
+	return float(low), float(high)
+
+def scaleToBytes(data, low, high, out=None):
+	""" Maps low..high onto 0..255 and writes the result into out (a uint8 array of the image shape, allocated if not given).
+	    Unsigned 8 and 16-bit images go through a lookup table, so there is no floating point copy of the frame. """
+	if out is None: out = numpy.empty(numpy.shape(data), dtype=numpy.uint8)
+	scale = 255 / max(high - low, 1e-10)
+	if data.dtype.kind=='u' and data.dtype.itemsize<=2:
+		lookup = numpy.arange(numpy.iinfo(data.dtype).max + 1, dtype=numpy.float32)
+		lookup = numpy.clip((lookup - low) * scale, 0, 255).astype(numpy.uint8)
+		numpy.take(lookup, data, out=out)
+		return out
+	scaled = numpy.subtract(data, low, dtype=numpy.float32)
+	scaled*= scale
+	numpy.clip(scaled, 0, 255, out=scaled)
+	numpy.copyto(out, scaled, casting='unsafe')
+	return out
+
+def stretch(data, lo=5, hi=95):
+	""" Returns a uint8 version of the image where pixels below the lo percentile are 0 and above the hi percentile are 255. """
+	low, high = percentileLimits(data, lo, hi)
+	return scaleToBytes(data, low, high)
+
+class displayStretch:
+	""" Scales the frames of a run for display. The limits (percentiles or zscale) are measured on a subsampled grid and then reused
+	    for the next 'refresh' frames of the same shape, so most frames only pay for the scaling into the uint8 buffer. """
+	def __init__(self, lo=5, hi=95, method="percentile", refresh=10, maxPixels=defaultSamples):
+		self.lo = lo
+		self.hi = hi
+		self.method = method
+		self.refresh = refresh
+		self.maxPixels = maxPixels
+		self.limits = None
+		self.shape = None
+		self.age = 0
+
+	def getLimits(self, data):
+		if self.limits is None or self.shape!=numpy.shape(data) or self.age>=self.refresh:
+			if self.method=="zscale": self.limits = zscaleLimits(data, maxPixels=self.maxPixels)
+			else: self.limits = percentileLimits(data, self.lo, self.hi, self.maxPixels)
+			self.shape = numpy.shape(data)
+			self.age = 0
+		self.age+= 1
+		return self.limits
+
+	def apply(self, data):
+		""" Returns a new uint8 image. A new buffer is used for each frame, as the previous one may still be on display. """
+		low, high = self.getLimits(data)
+		return scaleToBytes(data, low, high)
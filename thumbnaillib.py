@@ -0,0 +1,61 @@
+import concurrent.futures, math, os
+import numpy
+from PIL import Image, ImageDraw
+import loaderlib
+import stretchlib
+
+def toImage(imageArray, binning=1, caption=""):
+	""" Makes a greyscale PIL image from a 0-255 array, with the first row at the bottom (as matplotlib's origin='lower').
+	    A uint8 array is used without copying it. binning > 1 averages blocks of binning x binning pixels. """
+	imageArray = numpy.asarray(imageArray)
+	if imageArray.dtype!=numpy.uint8: imageArray = numpy.clip(imageArray, 0, 255).astype(numpy.uint8)
+	image = Image.fromarray(numpy.ascontiguousarray(imageArray[::-1]), mode="L")
+	if binning>1: image = image.reduce(int(binning))
+	if caption!="":
+		draw = ImageDraw.Draw(image)
+		draw.text((2, 2), caption, 255)
+	return image
+
+def thumbnailFilename(FITSfile, outputPath="."):
+	name = os.path.basename(FITSfile)
+	for extension in ['.gz', '.fz', '.fits', '.fit']:
+		if name.endswith(extension): name = name[:-len(extension)]
+	return os.path.join(outputPath, name + ".png")
+
+def writeThumbnail(FITSfile, outputPath=".", binning=4, lo=5, hi=95, caption=True):
+	""" Writes a PNG quick-look of a FITS file and returns its filename. """
+	FITSfile, header, imageData = loaderlib.loadFrame(FITSfile)
+	amplifiedImage = stretchlib.stretch(imageData, lo, hi)
+	label = ""
+	if caption: label = "%s %s"%(os.path.basename(FITSfile), header.get('EXPTIME', ""))
+	outputFilename = thumbnailFilename(FITSfile, outputPath)
+	toImage(amplifiedImage, binning, label).save(outputFilename, "PNG", compress_level=1)
+	return outputFilename
+
+def writeThumbnails(fileList, outputPath=".", binning=4, lo=5, hi=95, caption=True, workers=loaderlib.defaultWorkers):
+	""" Writes PNG quick-looks for a list of FITS files in a pool of processes. Returns the PNG filenames in list order. """
+	os.makedirs(outputPath, exist_ok=True)
+	if workers<1 or len(fileList)==0: return [ writeThumbnail(f, outputPath, binning, lo, hi, caption) for f in fileList ]
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+	n = len(fileList)
+	chunkSize = max(1, n // (4 * workers))
+	try:
+		return list(executor.map(writeThumbnail, fileList, [outputPath]*n, [binning]*n, [lo]*n, [hi]*n, [caption]*n, chunksize=chunkSize))
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+
+def contactSheet(thumbnailList, filename, columns=10, tileSize=200, labels=None):
+	""" Tiles a list of PNG quick-looks onto a single image, columns across, each scaled to fit a tileSize x tileSize square. """
+	rows = max(1, int(math.ceil(len(thumbnailList) / columns)))
+	sheet = Image.new("L", (columns * tileSize, rows * tileSize), 0)
+	draw = ImageDraw.Draw(sheet)
+	for index, thumbnailFile in enumerate(thumbnailList):
+		tile = Image.open(thumbnailFile)
+		tile.thumbnail((tileSize - 2, tileSize - 2))
+		x, y = (index % columns) * tileSize, (index // columns) * tileSize
+		sheet.paste(tile, (x + 1, y + 1))
+		tile.close()
+		if labels is not None: draw.text((x + 3, y + tileSize - 14), str(labels[index]), 255)
+	sheet.save(filename, "PNG")
+	print("Written contact sheet of %d frames to %s"%(len(thumbnailList), filename))
+	return filename
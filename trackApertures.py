@@ -8,17 +8,32 @@ import astropy
 import json
 import classes
 import shift
+import loaderlib
+import selectlib
+import previewlib
+import calibrationlib
+import badpixellib
+import statslib
+import registerlib
 
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Tracks a list of apertures across all frames')
-	parser.add_argument('inputfiles', type=str, help='A text file listing which files to process.')
+	parser.add_argument('inputfiles', type=str, help=selectlib.inputHelp)
 	parser.add_argument('-s', '--save', type=str, help="Save to the plot to a file.")
 	parser.add_argument('-b', '--bias', type=str, help="Name of the bias frame.")
 	parser.add_argument('-f', '--balance', type=str, help="Name of the balance (flat) frame.")
-	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Number of seconds to pause on each plot.")
+	parser.add_argument('-p', '--pause', type=float, default=0.01, help="Minimum number of seconds between preview updates. Frames arriving faster are skipped in the preview.")
 	parser.add_argument('-n', '--nframes', type=int, help="Number of frames to process before stopping. Default is all frames.")
-	parser.add_argument('--nopreview', action="store_true", help="Hide the image previews (speeds things up).")
+	parser.add_argument('--badpixels', type=str, help="Bad pixel mask FITS file (eg the _mask.fits.gz from findHotPixels.py). Bad pixels are replaced by the mean of their neighbours.")
+	parser.add_argument('--library', type=str, help="Calibration library directory. Masters matching the frames' configuration are used when --bias or --balance is not given.")
+	parser.add_argument('--workers', type=int, default=loaderlib.defaultWorkers, help="Number of threads used to load and decode the FITS files. Default is %d."%loaderlib.defaultWorkers)
+	parser.add_argument('--nopreview', action="store_true", help="Hide the image previews.")
+	parser.add_argument('--register', type=str, default="stars", choices=registerlib.registrationModes, help="How to measure the frame shifts. 'stars' matches the stars found in each frame, 'fft' uses phase correlation of the images and 'auto' uses phase correlation only for frames with fewer than --minstars stars and 'affine' matches triangles of stars, allowing for rotation and changes of scale. Default is stars.")
+	parser.add_argument('--minstars', type=int, default=5, help="Fewest stars needed to register a frame on its stars in 'auto' mode. Default is 5.")
+	parser.add_argument('--fftbin', type=int, default=1, help="Bin the frames by this factor for the phase correlation. Default is 1.")
+	parser.add_argument('--fftcrop', type=float, default=1.0, help="Fraction of each axis (centred) used for the phase correlation. Default is 1.0.")
+	parser.add_argument('--headless', action="store_true", help="Don't show any plots (for batch runs).")
 		
 
 	arg = parser.parse_args()
@@ -30,15 +45,11 @@ if __name__ == "__main__":
 	plotWidth = 8
 	plotHeight = 8/1.7
 
-	fileList = []
-
-	listFile = open(arg.inputfiles, 'rt')
-	for line in listFile:
-		filename = line.strip()
-		if filename[0]=="#": continue
-		fileList.append(filename)
-	listFile.close()
+	fileList = selectlib.getFileList(arg.inputfiles)
 
+	bias = None
+	balance = None
+	balanceBinning = (1, 1)
 	if arg.bias is not None:
 		print("loading the bias frame", arg.bias)
 		hdul = astropy.io.fits.open(arg.bias)
@@ -49,72 +60,122 @@ if __name__ == "__main__":
 		print("loading the balance frame", arg.balance)
 		hdul = astropy.io.fits.open(arg.balance)
 		balance = hdul[0].data
+		balanceBinning = calibrationlib.getBinFactors(hdul[0].header)
 		hdul.close()
 
+	if arg.library is not None:
+		library = calibrationlib.calibrationLibrary(arg.library)
+		libraryHeader = astropy.io.fits.getheader(fileList[0])
+		if arg.bias is None: bias = library.getMaster('bias', libraryHeader)
+	balances = None
+	if balance is not None: balances = calibrationlib.balanceCache(balance, balanceBinning)
+	elif arg.library is not None and library.getBalance(libraryHeader) is not None:
+		# Each frame gets the library's balance for its own window and binning
+		balances = calibrationlib.libraryBalances(library)
+	badPixels = None
+	if arg.badpixels is not None: badPixels = badpixellib.badPixelIndex(arg.badpixels)
+
+
+	if arg.headless: previewlib.setHeadless()
+	preview = previewlib.previewRenderer(enabled=not (arg.nopreview or arg.headless), interval=arg.pause)
 
 	rootApertures = classes.apertureDB()
 	rootApertures.load()
 	cat1 = numpy.array(rootApertures.makeCatalog())
 	offsets = []
 	frameList = classes.frameDB()
-	for frameNo, FITSfile in enumerate(fileList):
-		hdul = astropy.io.fits.open(FITSfile)
+	registration = None
+	asterisms = None
+	apertureCentre = numpy.mean(cat1, axis=0) if len(cat1)>0 else numpy.zeros(2)
+	for frameNo, (FITSfile, header, imageData) in enumerate(loaderlib.loadFrames(fileList[:arg.nframes], workers=arg.workers)):
 		FITSHeaders = {}
-		header = hdul[0].header
 		for h in header:
 			FITSHeaders[h] = header[h]
-		imageData = hdul[0].data
-		hdul.close()
 		# Subtract the bias
-		if arg.bias is not None: imageData = imageData - bias
+		if bias is not None: imageData = imageData - bias
 		# Divide by the balance frame (apply the flat)
-		if arg.balance is not None: imageData = numpy.divide(imageData, balance)
+		if balances is not None: imageData = numpy.divide(imageData, balances.get(header, numpy.shape(imageData)))
+		# Repair the bad pixels
+		if badPixels is not None: imageData = badPixels.forFrame(header, numpy.shape(imageData)).repair(imageData)
 		
-		# Find the point sources
-		from astropy.stats import sigma_clipped_stats
-		from photutils import datasets
-		mean, median, std = sigma_clipped_stats(imageData, sigma=3.0)
-		#print((mean, median, std))  
-		from photutils import DAOStarFinder
-		daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)  
-		sources = daofind(imageData - median)  
-		for col in sources.colnames:
-			sources[col].info.format = '%.8g'  # for consistent table output
-		#print(sources)
-		apertureList = classes.apertureDB()
 		cat2 = []
-		for s in sources:
-			target = classes.apertureClass((s['xcentroid'], s['ycentroid']), s['peak'])
-			apertureList.add(target)
-		apertureList.sort()
-		apertureList.enableTrackers(n=10)
-		cat2 = numpy.array(apertureList.makeCatalog())
-		#print(cat2)
+		if arg.register!="fft" or registration is None:
+			# Find the point sources
+			from photutils import datasets
+			mean, median, std = statslib.sigmaClippedStats(imageData, sigma=3.0)
+			#print((mean, median, std))  
+			from photutils import DAOStarFinder
+			daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)  
+			sources = daofind(imageData - median)  
+			if sources is None: sources = []
+			else:
+				for col in sources.colnames:
+					sources[col].info.format = '%.8g'  # for consistent table output
+			#print(sources)
+			apertureList = classes.apertureDB()
+			for s in sources:
+				target = classes.apertureClass((s['xcentroid'], s['ycentroid']), s['peak'])
+				apertureList.add(target)
+			apertureList.sort()
+			apertureList.enableTrackers(n=10)
+			cat2 = numpy.array(apertureList.makeCatalog())
+			#print(cat2)
 		
 		dmax = 50
 		fwhm = 4
 		psize = 0.5
 		mmax = 3
-		img, xp,yp,xr,yr = shift.vimage(cat1, cat2, dmax, psize, fwhm)
-		offset = { 'frame': frameNo, 'filesource': FITSfile, 'dx': xr, 'dy': yr}
+		if len(cat2)==0 and registration is None:
+			# Only phase correlation can register a frame without stars, and only once it has a reference
+			print("No stars found in %s, skipping it."%FITSfile)
+			if frameNo>=stopFrame-1: break
+			continue
+		rotation, scale = 0.0, 1.0
+		if asterisms is not None:
+			A, t, inds = shift.vaffine(referenceStars, cat2, mmax=mmax, index=asterisms)
+			if A is not None:
+				# The reference stars are at the apertures plus the reference offset. The shift is measured at the centroid of the
+				# apertures, so that the rotation and scale about it move the apertures as little as possible.
+				xr, yr = A @ (apertureCentre + referenceOffset) + t - apertureCentre
+				rotation, scale = shift.rotationScale(A)
+			else:
+				print("Could not match the asterisms in %s, assuming a translation only."%FITSfile)
+				img, xp,yp,xr,yr = shift.vimage(cat1, cat2, dmax, psize, fwhm)
+		elif registration is None or (arg.register=="auto" and len(cat2)>=arg.minstars):
+			img, xp,yp,xr,yr = shift.vimage(cat1, cat2, dmax, psize, fwhm)
+			if arg.register=="affine":
+				# Frames are matched to the stars found in this one, so keep its offset from the apertures
+				if len(cat2)<3: print("Only %d stars in the reference frame, can't match asterisms."%len(cat2))
+				else:
+					asterisms = shift.asterismIndex(cat2)
+					referenceStars = cat2
+					referenceOffset = numpy.array((xr, yr))
+			elif arg.register!="stars" and registration is None:
+				# Phase correlation gives shifts relative to this frame, so keep its offset from the apertures
+				if len(cat2)<arg.minstars: print("Only %d stars in the reference frame, its offset may be wrong."%len(cat2))
+				registration = registerlib.phaseRegistration(imageData, binning=arg.fftbin, crop=arg.fftcrop)
+				referenceOffset = (xr, yr)
+		else:
+			dx, dy, peak = registration.getShift(imageData)
+			xr, yr = referenceOffset[0] + dx, referenceOffset[1] + dy
+		offset = { 'frame': frameNo, 'filesource': FITSfile, 'dx': float(xr), 'dy': float(yr)}
 		offsets.append(offset)
 		
 		# Draw the image
-		if not arg.nopreview:
-			amplifiedImage = numpy.rot90(generallib.percentiles(imageData, 5, 95))
-			matplotlib.pyplot.imshow(amplifiedImage)
-			matplotlib.pyplot.gca().invert_yaxis()
-			matplotlib.pyplot.show(block=False)
-			matplotlib.pyplot.pause(arg.pause)
-			matplotlib.pyplot.clf()
+		preview.submit(numpy.rot90(imageData), title=FITSfile)
 		print("Frame number: {:d}  ({:.1f}, {:.1f})   : {:s}".format(frameNo, offset['dx'], offset['dy'], FITSfile))
-		frameInfo = { 'frame': frameNo, 'filesource': FITSfile, 'dx': xr, 'dy': yr}
+		frameInfo = { 'frame': frameNo, 'filesource': FITSfile, 'dx': float(xr), 'dy': float(yr)}
+		if arg.register=="affine":
+			frameInfo['rotation'] = rotation
+			frameInfo['scale'] = scale
+			frameInfo['centre'] = [ float(c) for c in apertureCentre ]
 		frameInfo['JD'] = FITSHeaders['JD']
 		frameInfo['exptime'] = FITSHeaders['EXPTIME']
 		frameInfo['JD'] = frameInfo['JD'] + frameInfo['exptime']/86400 / 2
 		
 		frameList.add(frameInfo)
 		if frameNo>=stopFrame-1: break
+	preview.close()
 
 	offsetPlot = matplotlib.pyplot.figure(figsize=(plotWidth, plotHeight))
 	xValues = [o['frame'] for o in offsets]
@@ -132,5 +193,5 @@ if __name__ == "__main__":
 	
 	frameList.save()
 
-	input("Press enter to continue")
+	if not arg.headless: input("Press enter to continue")
 	sys.exit()